@@ -0,0 +1,182 @@
+# Dreem Headband Sleep Phases Classification Challenge
+# Hyperband over the boosting rounds of LightGBM and XGBoost, with warm-started continuation
+
+try: from package.toolbox import *
+except: from toolbox import *
+try: from package.ensemble import *
+except: from ensemble import *
+
+# Estimator parameters without any meaning for the native training APIs
+SKLEARN_ONLY = ['n_estimators', 'n_jobs', 'mp', 'n_mp', 'silent', 'objective', 'class_weight', 'importance_type']
+
+# Writes features read by blocks to a libsvm file, loaded by both libraries out of core
+# vec refers to the FeatureBlocks to write
+# lab refers to the encoded labels of its rows
+# pth refers to the output file
+
+def spill_libsvm(vec, lab, pth):
+
+    fmt = '%d ' + ' '.join('{}:%.9g'.format(idx) for idx in range(vec.shape[1]))
+    ind = 0
+
+    with open(pth, 'wb') as raw:
+        for mat in vec.blocks():
+            np.savetxt(raw, np.hstack((lab[ind:ind+len(mat),None], mat)), fmt=fmt)
+            ind += len(mat)
+
+    return pth
+
+# Hyperband whose resource is the amount of boosting rounds
+# Surviving configurations continue from their boosters instead of being retrained
+
+class BoostingHyperband:
+
+    # Initialization
+    # nme refers to the library, either 'LGB' or 'XGB'
+    # sampler refers to the function drawing a configuration for nme
+    # max_iter refers to the maximal resource of a configuration
+    # rounds refers to the amount of boosting rounds per unit of resource
+    # eta refers to the proportion of configurations discarded at each rung
+    # patience refers to the rounds without improvement before a configuration stops
+    # n_jobs refers to the amount of threads of the boosters
+    def __init__(self, nme, sampler, max_iter=100, rounds=10, eta=3, patience=20, n_jobs=multiprocessing.cpu_count()):
+
+        self.nme = nme
+        self.sampler = sampler
+        self.max_iter = max_iter
+        self.rounds = rounds
+        self.eta = eta
+        self.patience = patience
+        self.n_jobs = n_jobs
+
+    # Native parameters of a configuration
+    # prm refers to the sampled estimator parameters
+    def native(self, prm):
+
+        prm = {key: val for key, val in prm.items() if key not in SKLEARN_ONLY}
+
+        if self.nme == 'LGB':
+            prm.update({'objective': 'multiclass', 'num_class': self.n_c, 'metric': 'multi_logloss'})
+            prm.update({'num_threads': self.n_jobs, 'verbose': -1})
+        if self.nme == 'XGB':
+            prm.update({'objective': 'multi:softprob', 'num_class': self.n_c, 'eval_metric': 'mlogloss'})
+            prm.update({'nthread': self.n_jobs})
+
+        return prm
+
+    # Live booster of a configuration, bound to the shared datasets
+    # prm refers to the native parameters
+    def booster(self, prm):
+
+        if self.nme == 'LGB':
+            bst = lgb.Booster(params=prm, train_set=self.dtr)
+            bst.add_valid(self.dva, 'valid')
+        if self.nme == 'XGB':
+            bst = xgb.Booster(prm, [self.dtr, self.dva])
+
+        return bst
+
+    # Continues a configuration up to the given amount of rounds, one update at a time
+    # cfg refers to the state of the configuration
+    # total refers to the targeted amount of rounds
+    def extend(self, cfg, total):
+
+        if cfg['bst'] is None: cfg['bst'] = self.booster(cfg['prm'])
+
+        while not cfg['done'] and len(cfg['his']) < total:
+
+            itr = len(cfg['his'])
+            if self.nme == 'LGB':
+                # Returns True once no split can be found anymore
+                end = cfg['bst'].update()
+                los = [ele[2] for ele in cfg['bst'].eval_valid() if ele[1] == 'multi_logloss'][0]
+            if self.nme == 'XGB':
+                cfg['bst'].update(self.dtr, itr)
+                end = False
+                los = float(cfg['bst'].eval_set([(self.dva, 'valid')], itr).split(':')[-1])
+            cfg['his'].append(los)
+
+            # Weighted validation loss, early stopping once it stalls
+            cfg['best'] = int(np.argmin(cfg['his']))
+            cfg['loss'] = cfg['his'][cfg['best']]
+            if end or len(cfg['his']) - 1 - cfg['best'] >= self.patience: cfg['done'] = True
+
+    # Builds the training and validation sets, once for all the configurations
+    # LightGBM bins them here, once, the boosters of the configurations only reference them
+    # Paths given as x_train and x_valid are libsvm files, see spill_libsvm
+    # val refers to the data representation folder used by ML_Model.learn
+    def datasets(self, val):
+
+        y_t = np.searchsorted(self.classes, val['y_train'])
+        y_e = np.searchsorted(self.classes, val['y_valid'])
+        ext = isinstance(val['x_train'], str)
+
+        if self.nme == 'LGB' and ext:
+            # Two passes over the file, without loading it as a whole
+            arg = {'params': {'two_round': True, 'header': False, 'verbose': -1}}
+            self.dtr = lgb.Dataset(val['x_train'], weight=val['w_train'], **arg).construct()
+            self.dva = lgb.Dataset(val['x_valid'], weight=val['w_valid'], reference=self.dtr, **arg).construct()
+        elif self.nme == 'LGB':
+            arg = {'params': {'verbose': -1}}
+            self.dtr = lgb.Dataset(val['x_train'], y_t, weight=val['w_train'], **arg).construct()
+            self.dva = lgb.Dataset(val['x_valid'], y_e, weight=val['w_valid'], reference=self.dtr, **arg).construct()
+
+        if self.nme == 'XGB' and ext:
+            # External memory, paged through a cache next to the files
+            self.dtr = xgb.DMatrix('{0}#{0}.cache'.format(val['x_train']), nthread=self.n_jobs)
+            self.dva = xgb.DMatrix('{0}#{0}.cache'.format(val['x_valid']), nthread=self.n_jobs)
+            self.dtr.set_weight(val['w_train'])
+            self.dva.set_weight(val['w_valid'])
+        elif self.nme == 'XGB':
+            self.dtr = xgb.DMatrix(val['x_train'], label=y_t, weight=val['w_train'], nthread=self.n_jobs)
+            self.dva = xgb.DMatrix(val['x_valid'], label=y_e, weight=val['w_valid'], nthread=self.n_jobs)
+
+    # Runs the search
+    # val refers to the data representation folder used by ML_Model.learn
+    # skip_brackets refers to the amount of brackets skipped, the most exploratory ones
+    # Unlike skip_last of the hyperband package, which skips the last rung of each bracket
+    def run(self, val, skip_brackets=0):
+
+        self.classes = np.unique(val['y_train'])
+        self.n_c = len(self.classes)
+        self.datasets(val)
+
+        s_m = int(log(self.max_iter) / log(self.eta) + 1e-9)
+        bdg = (s_m + 1) * self.max_iter
+        res, self.best = [], None
+
+        for brk in reversed(range(s_m + 1 - skip_brackets)):
+
+            num = int(ceil(bdg / self.max_iter / (brk + 1) * self.eta ** brk))
+            rsc = self.max_iter * self.eta ** (-brk)
+            lst = []
+            for _ in range(num):
+                prm = self.sampler(self.nme)
+                lst.append({'params': prm, 'prm': self.native(prm), 'bst': None, 'his': [], 'done': False})
+
+            for rng in range(brk + 1):
+
+                # Survivors are continued up to the resource of the rung
+                tot = int(round(rsc * self.eta ** rng * self.rounds))
+                for cfg in lst: self.extend(cfg, max(1, tot))
+                lst = sorted(lst, key=lambda x: x['loss'])
+                if self.best is None or lst[0]['loss'] < self.best['loss']: self.best = lst[0]
+
+                res += [{'params': cfg['params'], 'loss': cfg['loss'], 'rounds': cfg['best'] + 1} for cfg in lst]
+                lst = lst[:int(num * self.eta ** (-rng-1))]
+                if len(lst) == 0: break
+
+        return res
+
+    # Best booster, cut at its best iteration, without refitting
+    def model(self):
+
+        bst, rnd = self.best['bst'], self.best['best'] + 1
+        # Detaches the model from the shared datasets
+        if self.nme == 'LGB': bst = lgb.Booster(model_str=bst.model_to_string(num_iteration=rnd))
+        if self.nme == 'XGB':
+            cpy = xgb.Booster()
+            cpy.load_model(bytearray(bst.save_raw()))
+            bst = cpy
+
+        return BoostedClassifier(bst, self.nme, rnd, self.classes)
@@ -16,13 +16,65 @@ def iso_sampling(args):
 
     return z_m + K.exp(0.5 * z_l) * eps
 
+# Prepares the batches of a Sequence in a background thread
+
+class Prefetcher:
+
+    # Initialization
+    # seq refers to the keras Sequence
+    # size refers to the amount of batches prepared in advance
+    def __init__(self, seq, size=4):
+
+        self.seq = seq
+        self.size = size
+
+    def __len__(self):
+
+        return len(self.seq)
+
+    # One pass over the Sequence, the producer stopping with the consumer
+    def __iter__(self):
+
+        que = queue.Queue(maxsize=self.size)
+        end = threading.Event()
+
+        # Waits for some room unless the consumer stopped
+        def push(itm):
+            while not end.is_set():
+                try: 
+                    que.put(itm, timeout=0.1)
+                    return True
+                except queue.Full: pass
+            return False
+
+        def produce():
+            try:
+                for idx in range(len(self.seq)):
+                    if not push((True, self.seq[idx])): return
+            except Exception as err: push((False, err))
+            else: push((False, None))
+
+        thr = threading.Thread(target=produce)
+        thr.daemon = True
+        thr.start()
+
+        try:
+            while True:
+                boo, itm = que.get()
+                if boo: yield itm
+                elif itm is None: break
+                else: raise itm
+        finally: 
+            end.set()
+            self.seq.on_epoch_end()
+
 # Defines a specific metric for classification
 
 class Metrics(Callback):
 
     # Initialization
-    # val_gen refers to the validation generator
-    # steps for when the metric must stop the evaluation
+    # val_gen refers to the validation generator, or a Sequence read through a Prefetcher
+    # steps for when the metric must stop the evaluation, unused with a Sequence
     def __init__(self, val_gen, steps):
 
         super(Callback, self).__init__()
@@ -37,10 +89,13 @@ class Metrics(Callback):
 
         # Defines the tools for prediction
         ind, prd, lab = 0, [], []
+        # A Sequence is evaluated once entirely
+        if isinstance(self.val_gen, Sequence): gen, stp = Prefetcher(self.val_gen), np.inf
+        else: gen, stp = self.val_gen, self.step
 
-        for vec in self.val_gen:
+        for vec in gen:
             # Iterate according to the right stopping point
-            if ind <= self.step :
+            if ind <= stp :
                 lab += [np.argmax(ele) for ele in vec[1][0]]
                 prd += [np.argmax(pbs) for pbs in self.model.predict(vec[0])[0]]
                 ind += 1
@@ -109,35 +164,6 @@ class AdaptiveDropout(Layer):
 
         return dict(list(base_config.items()) + list(config.items()))
 
-# Aims at shuffling the data for better generalization
-
-class DataShuffler(Callback):
-
-    # Initialization
-    # dtb_path refers to the database path
-    # rounds refers to the amount of rounds for which the data is shuffled
-    def __init__(self, dtb_path, rounds):
-
-        super(Callback, self).__init__()
-
-        self.pth = dtb_path
-        self.rnd = rounds
-
-    # Shuffles the data at each end of epoch
-    def on_epoch_end(self, epoch, logs=None):
-
-        if epoch % self.rnd == 0:
-
-            with h5py.File(self.pth, 'a') as dtb:
-
-                i_t = shuffle(np.arange(dtb['lab_t'].shape[0]))
-                for key in [ele for ele in dtb.keys() if ele[-1] == 't']:
-                    dtb[key][...] = dtb[key].value[i_t]
-
-        else: pass
-
-        return
-
 # First layer for landscapes ponderation
 
 class SilhouetteLayer(Layer):
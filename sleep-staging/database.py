@@ -5,13 +5,389 @@
 try: from package.features import *
 except: from features import *
 
+# Content-addressed storage of feature blocks
+
+class FeatureCache:
+
+    # Initialization
+    # storage refers to where to store the blocks
+    def __init__(self, storage='./dataset/cache'):
+
+        self.storage = storage
+        self.idx_pth = '{}/index.json'.format(storage)
+
+        if not os.path.exists(storage): os.makedirs(storage)
+        # Digests of the already hashed datasets
+        if os.path.exists(self.idx_pth):
+            with open(self.idx_pth, 'r') as raw: self.index = json.load(raw)
+        else: self.index = dict()
+
+    # Digest of the content of some datasets, reused while their file is unchanged
+    # pth refers to the HDF5 file
+    # keys refers to the datasets to hash
+    # chunk refers to the amount of rows read at once
+    # rows refers to the amount of leading rows to hash, all of them by default
+    def fingerprint(self, pth, keys, chunk=4096, rows=None):
+
+        sta = os.stat(pth)
+        ref = '|'.join([os.path.abspath(pth), str(sta.st_mtime_ns), str(sta.st_size)] + keys)
+        if rows is not None: ref = '{}|{}'.format(ref, rows)
+        if ref in self.index: return self.index[ref]
+
+        sha = hashlib.sha1()
+        with h5py.File(pth, 'r') as dtb:
+            for key in keys:
+                dts = dtb[key]
+                num = dts.shape[0] if rows is None else min(rows, dts.shape[0])
+                sha.update(json.dumps([key, (num,) + dts.shape[1:], str(dts.dtype)]).encode())
+                for beg in range(0, num, chunk):
+                    sha.update(np.ascontiguousarray(dts[beg:min(beg+chunk, num)]).tobytes())
+
+        self.index[ref] = sha.hexdigest()
+        with open(self.idx_pth, 'w') as raw: json.dump(self.index, raw)
+
+        return self.index[ref]
+
+    # Identifier of a block
+    # digest refers to the fingerprint of the input datasets
+    # channel refers to the name of the channel
+    # family refers to the feature family, whose version is looked up
+    # params refers to a dictionnary of parameters
+    def identify(self, digest, channel, family, params):
+
+        key = json.dumps([digest, channel, family, FAMILIES[family], params], sort_keys=True)
+
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    # Retrieves a block, None when missing
+    # cid refers to the block identifier
+    def get(self, cid):
+
+        pth = '{}/{}.npy'.format(self.storage, cid)
+        if os.path.exists(pth): return np.load(pth, mmap_mode='r')
+        else: return None
+
+    # Opens a block to be filled by rows
+    # cid refers to the block identifier
+    # shape refers to the shape of the block
+    def create(self, cid, shape):
+
+        pth = '{}/{}.tmp.npy'.format(self.storage, cid)
+
+        return np.lib.format.open_memmap(pth, mode='w+', dtype='float64', shape=shape)
+
+    # Makes a filled block available
+    # cid refers to the block identifier
+    # blc refers to the array obtained through create
+    def commit(self, cid, blc):
+
+        blc.flush()
+        del blc
+        os.rename('{}/{}.tmp.npy'.format(self.storage, cid), '{}/{}.npy'.format(self.storage, cid))
+
+        return self.get(cid)
+
+# Rows of a scaled dataset seen through the indexes of a fold
+
+class IndexedDataset:
+
+    # Initialization
+    # dts refers to the source h5py dataset
+    # idx refers to the indexes of the rows, None for all of them
+    def __init__(self, dts, idx=None):
+
+        self.dts = dts
+        self.idx = idx
+        self.dtype = dts.dtype
+        if idx is None: self.shape = dts.shape
+        else: self.shape = (len(idx),) + dts.shape[1:]
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    # Reads the rows, sorted for h5py then put back in order
+    # sel refers to a position, a slice or an array of positions
+    def __getitem__(self, sel):
+
+        if self.idx is None: return self.dts[sel]
+        # A single row, without its first axis as with h5py
+        if isinstance(sel, (int, np.integer)): return self.dts[int(self.idx[sel])]
+
+        row = np.asarray(self.idx[sel]).ravel()
+        if len(row) == 0: return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        srt = np.argsort(row, kind='mergesort')
+        unq, inv = np.unique(row[srt], return_inverse=True)
+
+        # Dense selections are read as a single range
+        if unq[-1] - unq[0] + 1 <= 4 * len(unq): val = self.dts[unq[0]:unq[-1]+1][unq - unq[0]]
+        else: val = self.dts[unq]
+
+        res = np.empty((len(row),) + self.shape[1:], dtype=self.dtype)
+        res[srt] = val[inv]
+
+        return res
+
+    @property
+    def value(self):
+
+        return self[:]
+
+# Fold stored as indexes over the scaled files
+# Keys are named as in the physical folds, with the _t, _e and _v suffixes
+
+class IndexedFold:
+
+    # Initialization
+    # pth refers to the fold file
+    def __init__(self, pth):
+
+        self.pth = pth
+
+        with h5py.File(pth, 'r') as dtb:
+            self.idx = {'t': dtb['idx_t'][...], 'e': dtb['idx_e'][...], 'v': None}
+            self.src = {'t': dtb.attrs['train'], 'e': dtb.attrs['train'], 'v': dtb.attrs['valid']}
+
+        # Opens each source once
+        self.fls = dict()
+        for pth in set(self.src.values()): self.fls[pth] = h5_open(pth)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    # Release the sources
+    def close(self):
+
+        for fle in self.fls.values(): fle.close()
+        self.fls = dict()
+
+    # Available keys
+    def keys(self):
+
+        res = []
+        for fmt in ['t', 'e', 'v']:
+            res += ['{}_{}'.format(key, fmt) for key in self.fls[self.src[fmt]].keys()]
+
+        return res
+
+    # Access to a key of the fold
+    # key refers to the dataset name, with its suffix
+    def __getitem__(self, key):
+
+        nme, fmt = key[:-2], key[-1]
+
+        return IndexedDataset(self.fls[self.src[fmt]][nme], idx=self.idx[fmt])
+
+    def get(self, key, default=None):
+
+        try: return self[key]
+        except: return default
+
+# Opens a fold, either physical or stored as indexes
+# pth refers to the fold file
+
+def open_fold(pth):
+
+    with h5py.File(pth, 'r') as dtb: vrt = dtb.attrs.get('virtual', False)
+
+    if vrt: return IndexedFold(pth)
+    else: return h5_open(pth)
+
+# Feature matrix left on disk, read by blocks of rows
+# Row and column selections are only applied to the blocks being read
+
+class FeatureBlocks:
+
+    # Initialization
+    # pth refers to the fold or file holding the features
+    # key refers to the name of the feature matrix
+    # cols refers to the selected columns of the stored matrix, all of them by default
+    # rows refers to the selected rows of the stored matrix, all of them by default
+    # chunk refers to the amount of rows read at once
+    def __init__(self, pth, key, cols=None, rows=None, chunk=4096):
+
+        self.pth = pth
+        self.key = key
+        self.chunk = chunk
+
+        with open_fold(pth) as dtb: shp = dtb[key].shape
+        self.col = np.arange(shp[1]) if cols is None else np.arange(shp[1])[cols]
+        self.row = None if rows is None else np.asarray(rows)
+        self.shape = (shp[0] if rows is None else len(self.row), len(self.col))
+
+    def __len__(self):
+
+        return self.shape[0]
+
+    # Restriction to a subset of rows, nothing being read
+    # rows refers to the positions of the rows among the current ones
+    def __getitem__(self, rows):
+
+        if self.row is not None: rows = self.row[rows]
+
+        return FeatureBlocks(self.pth, self.key, cols=self.col, rows=rows, chunk=self.chunk)
+
+    # Restriction to a subset of columns, nothing being read
+    # support refers to the boolean mask of the kept columns among the current ones
+    def select(self, support):
+
+        return FeatureBlocks(self.pth, self.key, cols=self.col[support], rows=self.row, chunk=self.chunk)
+
+    # Iterates over the selected rows and columns, block by block
+    def blocks(self):
+
+        with open_fold(self.pth) as dtb:
+            dts = IndexedDataset(dtb[self.key], idx=self.row)
+            for beg in range(0, self.shape[0], self.chunk):
+                yield dts[beg:beg+self.chunk][:,self.col]
+
+    # Streaming variances and ranges of the columns, ignoring missing values as nanvar does
+    # Ranges are missing for the columns holding a missing value, as with np.ptp
+    def variances(self):
+
+        cnt, avg, msq = np.zeros(self.shape[1]), np.zeros(self.shape[1]), np.zeros(self.shape[1])
+        mnm, mxm = np.full(self.shape[1], np.inf), np.full(self.shape[1], -np.inf)
+        nan = np.zeros(self.shape[1], dtype=bool)
+
+        for mat in self.blocks():
+            mat = mat.astype('float64')
+            fin = ~np.isnan(mat)
+            # Moments of the block, over the present values of each column
+            num = np.sum(fin, axis=0)
+            mea = np.sum(np.where(fin, mat, 0.0), axis=0) / np.maximum(num, 1)
+            sqr = np.sum(np.where(fin, np.square(mat - mea), 0.0), axis=0)
+            # Merge of the block moments into the running ones
+            tot = cnt + num
+            dlt, wgt = mea - avg, num / np.maximum(tot, 1)
+            msq += sqr + np.square(dlt) * cnt * wgt
+            avg += dlt * wgt
+            cnt = tot
+            # Ranges, skipping the missing values
+            mnm, mxm = np.fmin(mnm, np.fmin.reduce(mat, axis=0)), np.fmax(mxm, np.fmax.reduce(mat, axis=0))
+            nan |= ~np.all(fin, axis=0)
+
+        var = np.where(cnt > 0, msq / np.maximum(cnt, 1), np.nan)
+        ptp = np.where(nan, np.nan, mxm - mnm)
+
+        return var, ptp
+
+# Fits a VarianceThreshold without loading the features
+# vec refers to the FeatureBlocks to select from
+# threshold refers to the variance threshold
+
+def variance_threshold(vec, threshold=0.0):
+
+    var, ptp = vec.variances()
+    # Constant columns are dropped whatever the rounding of their variance, as fit does
+    if threshold == 0: var = np.fmin(var, ptp)
+
+    vtf = VarianceThreshold(threshold=threshold)
+    vtf.variances_ = var
+
+    return vtf
+
+# Reads batches of rows out of a fold, keeping its handles open
+
+class BatchReader:
+
+    # Initialization
+    # pth refers to the fold file
+    # entries refers to the keys to read, tuples of keys being stacked along the second axis
+    # batch refers to the maximal amount of rows per batch
+    # depth refers to the amount of buffers in rotation, above the queue of the consumer
+    def __init__(self, pth, entries, batch, depth=12):
+
+        self.pth = pth
+        self.ent = entries
+        self.batch = batch
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.dtb = None
+        self.open()
+
+        # Preallocated buffers
+        self.buf, self.pos = [], 0
+        for _ in range(depth):
+            lst = []
+            for ent in self.ent:
+                if isinstance(ent, tuple): shp, typ = (len(ent),) + self.dts[ent[0]].shape[1:], self.dts[ent[0]].dtype
+                else: shp, typ = self.dts[ent].shape[1:], self.dts[ent].dtype
+                lst.append(np.empty((batch,) + shp, dtype=typ))
+            self.buf.append(lst)
+
+    # Opens the fold and its datasets
+    def open(self):
+
+        self.dtb = open_fold(self.pth)
+        self.dts = dict()
+        for ent in self.ent:
+            for key in (ent if isinstance(ent, tuple) else (ent,)): self.dts[key] = self.dtb[key]
+
+    # Releases the handles, reopened at the next read
+    def close(self):
+
+        if self.dtb is not None:
+            self.dtb.close()
+            self.dtb, self.dts = None, dict()
+
+    # Reads a range of rows into the next buffers
+    # ind refers to the first row
+    # num refers to the amount of rows
+    def read(self, ind, num):
+
+        with self.lock:
+
+            if self.dtb is None: self.open()
+            buf = self.buf[self.pos]
+            self.pos = (self.pos + 1) % self.depth
+
+            for ent, arr in zip(self.ent, buf):
+                if isinstance(ent, tuple):
+                    for idx, key in enumerate(ent): arr[:num,idx] = self.dts[key][ind:ind+num]
+                elif isinstance(self.dts[ent], h5py.Dataset):
+                    if num > 0: self.dts[ent].read_direct(arr, source_sel=np.s_[ind:ind+num], dest_sel=np.s_[:num])
+                else: arr[:num] = self.dts[ent][ind:ind+num]
+
+        return [arr[:num] for arr in buf]
+
+    # Reads scattered rows into the next buffers, through one sorted gather per key
+    # rows refers to the distinct rows to read, in the order of the batch
+    def gather(self, rows):
+
+        rows = np.asarray(rows)
+        num = len(rows)
+        srt = np.argsort(rows)
+        unq = rows[srt]
+
+        with self.lock:
+
+            if self.dtb is None: self.open()
+            buf = self.buf[self.pos]
+            self.pos = (self.pos + 1) % self.depth
+
+            for ent, arr in zip(self.ent, buf):
+                if num == 0: continue
+                if isinstance(ent, tuple):
+                    for idx, key in enumerate(ent): arr[srt,idx] = self.dts[key][unq]
+                else: arr[srt] = self.dts[ent][unq]
+
+        return [arr[:num] for arr in buf]
+
 # Defines the database architecture
 
 class Database:
 
     # Initialization
     # storage refers to where to get the datasets
-    def __init__(self, threads=multiprocessing.cpu_count(), storage='./dataset'):
+    # chunk refers to the amount of rows loaded at once
+    # batch refers to the amount of rows read at once by the models, aligning the chunks
+    # compression refers to the filter of the derived datasets, None for raw storage readable outside of h5py
+    def __init__(self, threads=multiprocessing.cpu_count(), storage='./dataset', chunk=4096, batch=64, compression=None):
 
         self.train_pth = '{}/train.h5'.format(storage)
         self.valid_pth = '{}/valid.h5'.format(storage)
@@ -19,17 +395,205 @@ class Database:
         self.valid_out = '{}/dts_valid.h5'.format(storage)
         self.train_sca = '{}/sca_train.h5'.format(storage)
         self.valid_sca = '{}/sca_valid.h5'.format(storage)
+        self.train_dgm = '{}/dgm_train.h5'.format(storage)
+        self.valid_dgm = '{}/dgm_valid.h5'.format(storage)
+        self.tda_lmt = '{}/TDA_limits.json'.format(storage)
 
         self.storage = storage
         self.sets_size = []
         self.threads = threads
-        
+        self.chunk = chunk
+        self.layout = {'batch': batch, 'compression': compression}
+        self.pool = None
+        self.tmp = None
+        self.maps = dict()
+        self.cache = FeatureCache('{}/cache'.format(storage))
+
         with h5py.File(self.train_pth, 'r') as dtb:
             self.sets_size.append(dtb['po_r'].shape[0])
             self.keys = list(dtb.keys())
         with h5py.File(self.valid_pth, 'r') as dtb:
             self.sets_size.append(dtb['po_r'].shape[0])
 
+    # Splits the rows into balanced blocks of at most chunk rows
+    # size refers to the amount of rows
+    def chunks(self, size):
+
+        bnd = np.linspace(0, size, num=int(np.ceil(size / self.chunk))+1).astype(int)
+
+        return list(zip(bnd[:-1], bnd[1:]))
+
+    # Context management, releasing the workers when leaving
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    # Long-lived pool of workers, shared by all the stages
+    # Workers are spawned, forked ones would inherit the deep-learning packages anyway
+    # The lightweight imports stay requested while the pool lives, as it may replace its workers
+    def executor(self):
+
+        if self.pool is None:
+            os.environ['LIGHT_IMPORTS'] = '1'
+            ctx = multiprocessing.get_context('spawn')
+            self.pool = ctx.Pool(processes=self.threads, initializer=init_worker)
+
+        return self.pool
+
+    # Release the workers and the scratch memory
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            os.environ.pop('LIGHT_IMPORTS', None)
+
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            self.tmp, self.maps = None, dict()
+
+    # Memory-mapped array shared with the workers, kept in RAM when /dev/shm exists
+    # shape refers to the shape of the array
+    def scratch(self, shape, dtype='float64'):
+
+        if self.tmp is None:
+            shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            self.tmp = tempfile.mkdtemp(prefix='database_', dir=shm)
+
+        fle, pth = tempfile.mkstemp(suffix='.mmap', dir=self.tmp)
+        os.close(fle)
+        val = np.memmap(pth, dtype=dtype, mode='w+', shape=tuple(shape))
+        self.maps[pth] = val.shape
+
+        return val
+
+    # Reads a block of rows directly into shared memory
+    # pth refers to the file in which the dataset is stored
+    # key refers to the dataset name
+    # beg, end refer to the rows to load
+    def load(self, pth, key, beg, end):
+
+        with h5py.File(pth, 'r') as dtb:
+            dts = dtb[key]
+            val = self.scratch((end-beg,) + dts.shape[1:], dtype=dts.dtype)
+            dts.read_direct(val, source_sel=np.s_[beg:end])
+
+        return val
+
+    # Drops the file behind a scratch array, the mapping stays valid
+    # val refers to an array built by scratch
+    def release(self, val):
+
+        if getattr(val, 'filename', None) in self.maps:
+            del self.maps[val.filename]
+            os.remove(val.filename)
+
+    # Makes sure an array lives in shared memory
+    # val refers to a 2D array
+    def share(self, val):
+
+        if self.maps.get(getattr(val, 'filename', None)) != val.shape:
+            tmp = self.scratch(val.shape, dtype=val.dtype)
+            tmp[...] = val
+            val = tmp
+
+        return val
+
+    # Multiprocessed mapping over the rows of a block
+    # Inputs and outputs transit through shared memory, workers only get row ranges
+    # fun refers to the function to apply
+    # val refers to a 2D array, ideally obtained through load
+    # batch refers whether fun takes sub-blocks instead of single rows
+    def apply(self, fun, val, batch=False):
+
+        val = self.share(val)
+
+        # The first row gives the output shape
+        fst = np.asarray(fun(val[:1])[0] if batch else fun(val[0]))
+        res = self.scratch((len(val),) + fst.shape, dtype=fst.dtype)
+        res[0] = fst
+
+        # Dispatch the remaining rows by ranges
+        inp = (val.filename, val.dtype, val.shape)
+        out = (res.filename, res.dtype, res.shape)
+        bnd = np.linspace(1, len(val), num=min(len(val)-1, 4*self.threads)+1).astype(int)
+        arg = [(fun, batch, inp, out, i, j) for i, j in zip(bnd[:-1], bnd[1:])]
+        self.executor().map(map_block, arg)
+
+        self.release(val)
+        self.release(res)
+
+        return res
+
+    # Multiprocessed persistence of the rows of a block
+    # Returns the amount of pairs of each row and the flat pairs, for both directions
+    # val refers to a 2D array, ideally obtained through load
+    def persistence(self, val):
+
+        val = self.share(val)
+
+        # One contiguous block per worker, the union-find is cheapest over many rows
+        inp = (val.filename, val.dtype, val.shape)
+        bnd = np.linspace(0, len(val), num=min(len(val), self.threads)+1).astype(int)
+        arg = [(inp, i, j) for i, j in zip(bnd[:-1], bnd[1:])]
+        out = self.executor().map(diagram_block, arg)
+
+        self.release(val)
+
+        return [(np.concatenate([ele[idx][0] for ele in out]), np.vstack([ele[idx][1] for ele in out])) for idx in range(2)]
+
+    # Multiprocessed derivation out of the stored diagrams of some epochs
+    # fun refers to the function applied to lists of diagrams
+    # pth refers to the HDF5 file of diagrams
+    # key refers to the channel
+    # beg, end refer to the epochs to consider
+    def derive(self, fun, pth, key, beg, end):
+
+        # The first epoch gives the output shape
+        fst = np.asarray(fun(read_diagrams(pth, key, beg, beg+1))[0])
+        res = self.scratch((end-beg,) + fst.shape, dtype=fst.dtype)
+        res[0] = fst
+
+        # Dispatch the remaining epochs by one contiguous range per worker
+        out = (res.filename, res.dtype, res.shape)
+        bnd = np.linspace(beg+1, end, num=min(end-beg-1, self.threads)+1).astype(int)
+        arg = [(fun, pth, key, out, beg, i, j) for i, j in zip(bnd[:-1], bnd[1:])]
+        self.executor().map(map_diagrams, arg)
+
+        self.release(res)
+
+        return res
+
+    # Creates an empty dataset to be filled by blocks
+    # dtb refers to an opened h5py file
+    # key refers to the dataset name
+    # shape refers to the final shape of the dataset
+    def allocate(self, dtb, key, shape, dtype='float64'):
+
+        if dtb.get(key): del dtb[key]
+        h5_dataset(dtb, key, shape=shape, dtype=dtype, **self.layout)
+
+    # Mean of the finite values of each column
+    # pth refers to the file in which the dataset is stored
+    # key refers to the dataset name
+    def column_means(self, pth, key):
+
+        with h5py.File(pth, 'r') as dtb: shp = dtb[key].shape
+        sms, cnt = np.zeros(shp[1]), np.zeros(shp[1])
+
+        for beg, end in self.chunks(shp[0]):
+            with h5py.File(pth, 'r') as dtb: val = dtb[key][beg:end]
+            msk = np.isfinite(val)
+            sms += np.sum(np.where(msk, val, 0.0), axis=0)
+            cnt += np.sum(msk, axis=0)
+
+        return sms / cnt
+
     # Load the corresponding labels
     # input refers to the input_file in which the labels are stored
     def load_labels(self, input='./dataset/label.csv'):
@@ -39,270 +603,320 @@ class Database:
         with h5py.File(self.train_out, 'a') as dtb:
             # Serialize the labels
             if dtb.get('lab'): del dtb['lab']
-            dtb.create_dataset('lab', data=lab.values)
+            h5_dataset(dtb, 'lab', data=lab.values, **self.layout)
 
     # Suppress the latent mean of signals
     def unshift(self):
 
         # Iterates over both the training and validation sets
-        for pth in [self.train_pth, self.valid_pth]:
+        for pth, size in zip([self.train_pth, self.valid_pth], self.sets_size):
 
             for key in ['acc_x', 'acc_y', 'acc_z', 'eeg_1', 'eeg_2', 'eeg_3', 'eeg_4', 'po_r', 'po_ir']:
-                with h5py.File(pth, 'a') as dtb:
-                    sts = StandardScaler(with_std=False)
-                    dtb[key][...] = np.transpose(sts.fit_transform(np.transpose(dtb[key].value)))
-                    del sts
+                for beg, end in self.chunks(size):
+                    with h5py.File(pth, 'a') as dtb:
+                        sts = StandardScaler(with_std=False)
+                        dtb[key][beg:end] = np.transpose(sts.fit_transform(np.transpose(dtb[key][beg:end])))
+                        del sts
 
-    # Build the norm of the accelerometers
-    def add_norm_acc(self):
+    # Build the norm of a group of signals
+    # keys refers to the signals to aggregate
+    # new refers to the name of the output dataset
+    def add_norm(self, keys, new):
 
         # Iterates over both the training and validation sets
-        for pth, out in zip([self.train_pth, self.valid_pth], [self.train_out, self.valid_out]):
+        for pth, out, size in zip([self.train_pth, self.valid_pth], [self.train_out, self.valid_out], self.sets_size):
 
-            with h5py.File(pth, 'r') as dtb:
+            with h5py.File(pth, 'r') as dtb: shp = dtb[keys[0]].shape
+            for fle in [pth, out]:
+                with h5py.File(fle, 'a') as dtb: self.allocate(dtb, new, shp)
+
+            for beg, end in self.chunks(size):
 
                 # Aggregates the values
-                tmp = np.square(dtb['acc_x'].value)
-                tmp += np.square(dtb['acc_y'].value)
-                tmp += np.square(dtb['acc_z'].value)
-
-            # Serialize the result
-            with h5py.File(pth, 'a') as dtb:
-                if dtb.get('norm_acc'): del dtb['norm_acc']
-                dtb.create_dataset('norm_acc', data=np.sqrt(tmp))
-            with h5py.File(out, 'a') as dtb:
-                if dtb.get('norm_acc'): del dtb['norm_acc']
-                dtb.create_dataset('norm_acc', data=np.sqrt(tmp))
+                with h5py.File(pth, 'r') as dtb:
+                    tmp = np.square(dtb[keys[0]][beg:end])
+                    for key in keys[1:]: tmp += np.square(dtb[key][beg:end])
 
-            # Memory efficiency
-            del tmp
+                # Serialize the result
+                for fle in [pth, out]:
+                    with h5py.File(fle, 'a') as dtb: dtb[new][beg:end] = np.sqrt(tmp)
+
+                # Memory efficiency
+                del tmp
+
+    # Build the norm of the accelerometers
+    def add_norm_acc(self):
+
+        self.add_norm(['acc_x', 'acc_y', 'acc_z'], 'norm_acc')
 
     # Build the norm of the EEGs
     def add_norm_eeg(self):
 
-        # Iterates over both the training and validation sets
-        for pth, out in zip([self.train_pth, self.valid_pth], [self.train_out, self.valid_out]):
+        self.add_norm(['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4'], 'norm_eeg')
 
-            with h5py.File(pth, 'r') as dtb:
+    # Retrieves or computes a block of features
+    # pth refers to the file in which the signals are stored
+    # keys refers to the signals the family relies on
+    # family refers to the feature family
+    # brain refers whether the signal is an EEG
+    def feature_block(self, pth, keys, family, brain=False):
 
-                # Aggregates the values
-                tmp = np.square(dtb['eeg_1'].value)
-                tmp += np.square(dtb['eeg_2'].value)
-                tmp += np.square(dtb['eeg_3'].value)
-                tmp += np.square(dtb['eeg_4'].value)
-
-            # Serialize the result
-            with h5py.File(pth, 'a') as dtb:
-                if dtb.get('norm_eeg'): del dtb['norm_eeg']
-                dtb.create_dataset('norm_eeg', data=np.sqrt(tmp))
-            with h5py.File(out, 'a') as dtb:
-                if dtb.get('norm_eeg'): del dtb['norm_eeg']
-                dtb.create_dataset('norm_eeg', data=np.sqrt(tmp))
+        dig = self.cache.fingerprint(pth, keys, chunk=self.chunk)
+        cid = self.cache.identify(dig, '-'.join(keys), family, {'brain': brain})
+        blc = self.cache.get(cid)
+        if blc is not None: return blc
 
-            # Memory efficiency
-            del tmp
+        with h5py.File(pth, 'r') as dtb: size = dtb[keys[0]].shape[0]
+        fun = partial(compute_family_batch, family=family, brain=brain)
+
+        for beg, end in self.chunks(size):
+
+            # Multiprocessed computation
+            if len(keys) == 1: val = self.load(pth, keys[0], beg, end)
+            else:
+                with h5py.File(pth, 'r') as dtb: val = np.stack([dtb[key][beg:end] for key in keys], axis=1)
+            res = self.apply(fun, val, batch=True)
+
+            # Serialize the output
+            if beg == 0: blc = self.cache.create(cid, (size, res.shape[1]))
+            blc[beg:end] = res
+            del val, res
+
+        return self.cache.commit(cid, blc)
 
     # Build the features for each channel
+    # Blocks of features are cached per channel and family, only missing ones are computed
     # n_components refers to the PCA transformation
     def add_features(self, n_components=5):
 
+        oth = ['po_r', 'po_ir', 'acc_x', 'acc_y', 'acc_z', 'norm_acc']
+        eeg = ['norm_eeg', 'eeg_1', 'eeg_2', 'eeg_3', 'eeg_4']
+        lst = ['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4', 'po_r', 'po_ir', 'norm_acc', 'norm_eeg']
+
+        # Defines the PCA transforms adapted to incremental learning
+        pca = dict()
+        for key in tqdm.tqdm(lst):
+            pca[key] = IncrementalPCA(n_components=n_components)
+            # Partial fit over training and validation
+            for pth, size in zip([self.train_pth, self.valid_pth], self.sets_size):
+                for beg, end in self.chunks(size):
+                    with h5py.File(pth, 'r') as dtb: pca[key].partial_fit(dtb[key][beg:end])
+
         # Build the features over the initial signals
-        for pth, out in zip([self.train_pth, self.valid_pth], [self.train_out, self.valid_out]):
-
-            res = []
-
-            # Iterates over the other signals
-            for key in tqdm.tqdm(['po_r', 'po_ir', 'acc_x', 'acc_y', 'acc_z', 'norm_acc']):
-
-                # Load the corresponding values
-                with h5py.File(pth, 'r') as dtb: val = dtb[key].value
-                # Multiprocessed computation
-                pol = multiprocessing.Pool(processes=self.threads)
-                fun = partial(compute_features, brain=False)
-                res.append(np.asarray(pol.map(fun, val)))
-                pol.close()
-                pol.join()
-                del val
-
-            # Iterates over the EEG signals
-            for key in tqdm.tqdm(['norm_eeg', 'eeg_1', 'eeg_2', 'eeg_3', 'eeg_4']):
-
-                # Load the corresponding values
-                with h5py.File(pth, 'r') as dtb: val = dtb[key].value
-                # Multiprocessed computation
-                pol = multiprocessing.Pool(processes=self.threads)
-                fun = partial(compute_features, brain=True)
-                res.append(np.asarray(pol.map(fun, val)))
-                pol.close()
-                pol.join()
-                del val
+        for pth, out, size in zip([self.train_pth, self.valid_pth], [self.train_out, self.valid_out], self.sets_size):
+
+            blc = []
+
+            # Iterates over the signals
+            for key in tqdm.tqdm(oth + eeg):
+                for fam in feature_families(brain=key in eeg):
+                    blc.append(self.feature_block(pth, [key], fam, brain=key in eeg))
 
             # Relation between EEGs
-            with h5py.File(pth, 'r') as dtb: shp = dtb['eeg_1'].shape[0]
-            # Multiprocessed computation
-            pol = multiprocessing.Pool(processes=self.threads)
-            fun = partial(compute_distances, h5_path=pth)
-            res.append(np.asarray(pol.map(fun, np.arange(shp))))
-            pol.close()
-            pol.join()
+            blc.append(self.feature_block(pth, eeg[1:], 'distances'))
 
-            # Serialize the output
-            with h5py.File(out, 'a') as dtb:
-                if dtb.get('fea'): del dtb['fea']
-                dtb.create_dataset('fea', data=np.hstack(tuple(res)))
-                del res
+            # Assemble the features with the PCA reductions
+            for beg, end in self.chunks(size):
 
-        # Build the features relative to their PCA reduction
-        train_pca, valid_pca = [], []
-        lst = ['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4', 'po_r', 'po_ir', 'norm_acc', 'norm_eeg']
+                res = [ele[beg:end] for ele in blc]
+                for key in lst:
+                    with h5py.File(pth, 'r') as dtb: res.append(pca[key].transform(dtb[key][beg:end]))
 
-        # Iterates over the keys
-        for key in tqdm.tqdm(lst):
+                # Serialize the output
+                res = np.hstack(tuple(res))
+                with h5py.File(out, 'a') as dtb:
+                    if beg == 0: self.allocate(dtb, 'fea', (size, res.shape[1]))
+                    dtb['fea'][beg:end] = res
+                del res
 
-            # Defines the PCA transform adapted to incremental learning
-            pca = IncrementalPCA(n_components=n_components)
-            # Partial fit over training and validation
-            for pth in [self.train_pth, self.valid_pth]:
-                with h5py.File(pth, 'r') as dtb:
-                    pca.partial_fit(dtb[key].value)
-            # Apply transformation on training set
-            with h5py.File(self.train_pth, 'r') as dtb:
-                train_pca.append(pca.transform(dtb[key].value))
-            # Apply transformation on validation set
-            with h5py.File(self.valid_pth, 'r') as dtb:
-                valid_pca.append(pca.transform(dtb[key].value))
-
-        # Serialization for the training results
-        with h5py.File(self.train_out, 'a') as dtb:
-            fea, pca = dtb['fea'].value, np.hstack(tuple(train_pca))
-            del dtb['fea']
-            dtb.create_dataset('fea', data=np.hstack((fea, pca)))
-            del fea, pca
-        # Serialization for the validation results
-        with h5py.File(self.valid_out, 'a') as dtb:
-            fea, pca = dtb['fea'].value, np.hstack(tuple(valid_pca))
-            del dtb['fea']
-            dtb.create_dataset('fea', data=np.hstack((fea, pca)))
-            del fea, pca
+            # Memory efficiency
+            del blc
 
         # Memory efficiency
-        del train_pca, valid_pca, lst
+        del pca, lst
+
+    # Computes the persistence diagrams of each EEG channel once
+    # Each direction is stored as flat births and deaths, with the offsets of each epoch
+    # Groups remember the digest of the rows they cover, so that only new rows are computed
+    def add_persistence(self):
+
+        for pth, dgm, size in zip([self.train_pth, self.valid_pth],
+                                  [self.train_dgm, self.valid_dgm], self.sets_size):
+
+            # Iterates over the EEGs signals
+            for key in tqdm.tqdm(range(1, 5)):
+
+                nme, rows = 'eeg_{}'.format(key), 0
+
+                with h5py.File(dgm, 'a') as dtb:
+
+                    # Keeps the existing diagrams if their rows are unchanged
+                    grp = dtb.get(nme)
+                    if grp is not None and 0 < grp.attrs.get('rows', 0) <= size:
+                        dig = self.cache.fingerprint(pth, [nme], chunk=self.chunk, rows=int(grp.attrs['rows']))
+                        if grp.attrs.get('digest') == dig: rows = int(grp.attrs['rows'])
+
+                    if rows == 0:
+                        if grp is not None: del dtb[nme]
+                        grp = dtb.create_group(nme)
+                        for drc in ['up', 'dw']:
+                            grp.create_dataset('off_{}'.format(drc), data=np.zeros(1, dtype='int64'), maxshape=(None,), chunks=(65536,))
+                            for fld in ['brt', 'dth']:
+                                grp.create_dataset('{}_{}'.format(fld, drc), shape=(0,), maxshape=(None,),
+                                                   chunks=(65536,), dtype='float64', compression=self.layout['compression'])
+
+                    for drc in ['up', 'dw']: grp['off_{}'.format(drc)].resize((size+1,))
+
+                for beg, end in self.chunks(size - rows):
+
+                    # Multiprocessed computation
+                    beg, end = beg + rows, end + rows
+                    res = self.persistence(self.load(pth, nme, beg, end))
+
+                    # Serialize the output
+                    with h5py.File(dgm, 'a') as dtb:
+                        for drc, (cnt, pai) in zip(['up', 'dw'], res):
+                            off = dtb[nme]['off_{}'.format(drc)]
+                            fst = int(off[beg])
+                            off[beg+1:end+1] = fst + np.cumsum(cnt)
+                            if len(pai) == 0: continue
+                            for idx, fld in enumerate(['brt', 'dth']):
+                                dts = dtb[nme]['{}_{}'.format(fld, drc)]
+                                dts.resize((fst + len(pai),))
+                                dts[fst:] = pai[:,idx]
+
+                    # Memory efficiency
+                    del res
+
+                # Rows covered by the diagrams
+                with h5py.File(dgm, 'a') as dtb:
+                    dtb[nme].attrs['rows'] = size
+                    dtb[nme].attrs['digest'] = self.cache.fingerprint(pth, [nme], chunk=self.chunk, rows=size)
 
     # Compute the persistence limits for each EEG channel
+    # Extrema are kept per set and channel along with the digest of the rows they cover
+    # New rows only update them, through partial extrema computed by the workers
+    # The diagrams are expected to be up to date, see add_persistence
     def get_persistence_limits(self):
 
-        tda_lmt = './dataset/TDA_limits.pk'
-        # Limitations of persistence diagrams
-        if os.path.exists(tda_lmt):
+        if os.path.exists(self.tda_lmt):
+            with open(self.tda_lmt, 'r') as raw: lmt = json.load(raw)
+        else: lmt = dict()
+        # Entries of other files stay in the json, without widening the limits
+        lst = []
 
-            # Load the existing thresholds
-            with open(tda_lmt, 'rb') as raw: dic = pickle.load(raw)
+        for pth, dgm, size in zip([self.train_pth, self.valid_pth],
+                                  [self.train_dgm, self.valid_dgm], self.sets_size):
 
-        else:
+            # Iterates over the EEGs signals
+            for key in range(1, 5):
 
-            lmt = []
-            # Get the betti curves limitations
-            for pth in [self.train_pth, self.valid_pth]:
+                nme = 'eeg_{}'.format(key)
+                ref = '{}/{}'.format(os.path.basename(pth), nme)
+                lst.append(ref)
+                ext, rows = [np.inf, -np.inf, np.inf, -np.inf], 0
 
-                # Iterates over the EEGs signals
-                for key in tqdm.tqdm(range(1, 5)):
+                # Reuses the extrema of unchanged rows
+                if ref in lmt and 0 < lmt[ref]['rows'] <= size:
+                    if lmt[ref]['digest'] == self.cache.fingerprint(pth, [nme], chunk=self.chunk, rows=lmt[ref]['rows']):
+                        ext, rows = lmt[ref]['extrema'], lmt[ref]['rows']
 
-                    # Load the corresponding values
-                    with h5py.File(pth, 'r') as dtb: 
-                        val = dtb['eeg_{}'.format(key)].value
+                # Partial extrema of the new rows
+                for beg, end in self.chunks(size - rows):
+                    beg, end = beg + rows, end + rows
+                    bnd = np.linspace(beg, end, num=min(end-beg, 4*self.threads)+1).astype(int)
+                    arg = [(dgm, nme, i, j) for i, j in zip(bnd[:-1], bnd[1:])]
+                    for val in self.executor().map(diagram_extrema, arg):
+                        ext = [min(ext[0], val[0]), max(ext[1], val[1]), min(ext[2], val[2]), max(ext[3], val[3])]
 
-                    # Computes the persistent limits for the relative patient
-                    pol = multiprocessing.Pool(processes=self.threads)
-                    lmt.append(np.asarray(pol.map(persistent_limits, val)))
-                    pol.close()
-                    pol.join()
-                    # Memory efficiency
-                    del val, pol
+                dig = self.cache.fingerprint(pth, [nme], chunk=self.chunk, rows=size)
+                lmt[ref] = {'rows': size, 'digest': dig, 'extrema': [float(ele) for ele in ext]}
 
-            # Extracts the main limits
-            lmt = np.vstack(tuple(lmt))
-            mnu, mxu = min(lmt[:,0]), max(lmt[:,1]) 
-            mnd, mxd = min(lmt[:,2]), max(lmt[:,3])
-            # Memory efficiency
-            del lmt
+        # Serialize the obtained thresholds
+        with open(self.tda_lmt, 'w') as raw: json.dump(lmt, raw)
 
-            # Serialize the obtained threshold
-            with open(tda_lmt, 'wb') as raw:
-                dic = {'min_up': mnu, 'max_up': mxu, 'min_dw': mnd, 'max_dw': mxd}
-                pickle.dump(dic, raw)
+        ext = np.asarray([lmt[ref]['extrema'] for ref in lst])
+        dic = {'min_up': np.min(ext[:,0]), 'max_up': np.max(ext[:,1]),
+               'min_dw': np.min(ext[:,2]), 'max_dw': np.max(ext[:,3])}
 
         return dic
 
-    # Build the corresponding Betti curves
+    # Build the corresponding Betti curves out of the stored diagrams
     def add_betti_curves(self):
 
-        # Retrieve the persistence limits
+        # Retrieve the persistence limits, out of up-to-date diagrams
+        self.add_persistence()
         dic = self.get_persistence_limits()
+        arg = {'mnu': dic['min_up'], 'mxu': dic['max_up'], 'mnd': dic['min_dw'], 'mxd': dic['max_dw']}
+        fun = partial(betti_curves_diagrams, **arg)
 
         # Build the betti curves
-        for pth, out in zip([self.train_pth, self.valid_pth],
-                            [self.train_out, self.valid_out]):
+        for dgm, out, size in zip([self.train_dgm, self.valid_dgm],
+                                  [self.train_out, self.valid_out], self.sets_size):
 
             # Iterates over the EEGs signals
             for key in tqdm.tqdm(range(1, 5)):
 
-                # Load the corresponding values
-                with h5py.File(pth, 'r') as dtb: 
-                    val = dtb['eeg_{}'.format(key)].value
-                    
-                # Multiprocessed computation
-                pol = multiprocessing.Pool(processes=self.threads)
-                arg = {'mnu': dic['min_up'], 'mxu': dic['max_up'], 'mnd': dic['min_dw'], 'mxd': dic['max_dw']}
-                fun = partial(compute_betti_curves, **arg)
-                res = np.asarray(pol.map(fun, val))
-                pol.close()
-                pol.join()
-                # Memory efficiency
-                del val, pol, arg, fun
-
-                # Serialize the output
                 with h5py.File(out, 'a') as dtb:
-                    new = 'bup_{}'.format(key)
-                    if dtb.get(new): del dtb[new]
-                    dtb.create_dataset(new, data=res[:,0,:])
-                    new = 'bdw_{}'.format(key)
-                    if dtb.get(new): del dtb[new]
-                    dtb.create_dataset(new, data=res[:,1,:])
-
-    # Build the corresponding landscapes
+                    self.allocate(dtb, 'bup_{}'.format(key), (size, 100))
+                    self.allocate(dtb, 'bdw_{}'.format(key), (size, 100))
+
+                for beg, end in self.chunks(size):
+
+                    # Multiprocessed computation
+                    res = self.derive(fun, dgm, 'eeg_{}'.format(key), beg, end)
+
+                    # Serialize the output
+                    with h5py.File(out, 'a') as dtb:
+                        dtb['bup_{}'.format(key)][beg:end] = res[:,0,:]
+                        dtb['bdw_{}'.format(key)][beg:end] = res[:,1,:]
+
+                    # Memory efficiency
+                    del res
+
+    # Build the corresponding landscapes out of the stored diagrams
     def add_landscapes(self):
 
-        # Retrieve the persistence limits
+        # Retrieve the persistence limits, out of up-to-date diagrams
+        self.add_persistence()
         dic = self.get_persistence_limits()
+        arg = {'mnu': dic['min_up'], 'mxu': dic['max_up'], 'mnd': dic['min_dw'], 'mxd': dic['max_dw']}
+        fun = partial(landscapes_diagrams, **arg)
 
-        # Build the betti curves
-        for pth, out in zip([self.train_pth, self.valid_pth],
-                            [self.train_out, self.valid_out]):
+        # Build the landscapes
+        for dgm, out, size in zip([self.train_dgm, self.valid_dgm],
+                                  [self.train_out, self.valid_out], self.sets_size):
 
-            res = []
             # Iterates over the EEGs signals
             for key in tqdm.tqdm(range(1, 5)):
 
-                # Load the corresponding values
-                with h5py.File(pth, 'r') as dtb: 
-                    val = dtb['eeg_{}'.format(key)].value
-                    
-                # Multiprocessed computation
-                pol = multiprocessing.Pool(processes=self.threads)
-                arg = {'mnu': dic['min_up'], 'mxu': dic['max_up'], 'mnd': dic['min_dw'], 'mxd': dic['max_dw']}
-                fun = partial(compute_landscapes, **arg)
-                res = np.asarray(pol.map(fun, val))
-                pol.close()
-                pol.join()
-
-                # Serialize the output
                 with h5py.File(out, 'a') as dtb:
-                    new = 'l_0_{}'.format(key)
-                    if dtb.get(new): del dtb[new]
-                    dtb.create_dataset(new, data=res[:,:10,:])
-                    new = 'l_1_{}'.format(key)
-                    if dtb.get(new): del dtb[new]
-                    dtb.create_dataset(new, data=res[:,10:,:])
+                    self.allocate(dtb, 'l_0_{}'.format(key), (size, 10, 100))
+                    self.allocate(dtb, 'l_1_{}'.format(key), (size, 10, 100))
+
+                for beg, end in self.chunks(size):
+
+                    # Multiprocessed computation
+                    res = self.derive(fun, dgm, 'eeg_{}'.format(key), beg, end)
+
+                    # Serialize the output
+                    with h5py.File(out, 'a') as dtb:
+                        dtb['l_0_{}'.format(key)][beg:end] = res[:,:10,:]
+                        dtb['l_1_{}'.format(key)][beg:end] = res[:,10:,:]
+
+                    # Memory efficiency
+                    del res
+
+    # Summary statistics of the stored diagrams of an EEG channel
+    # key refers to the index of the EEG channel
+    # dgm refers to the HDF5 file of diagrams
+    def tda_features(self, key, dgm=None):
+
+        dgm = self.train_dgm if dgm is None else dgm
+        with h5py.File(dgm, 'r') as dtb: size = len(dtb['eeg_{}'.format(key)]['off_up']) - 1
+        fun = partial(apply_diagrams, compute_tda_features)
+
+        return np.vstack([self.derive(fun, dgm, 'eeg_{}'.format(key), beg, end) for beg, end in self.chunks(size)])
 
     # Apply filtering and interpolation on the samples
     def build_series(self):
@@ -318,27 +932,26 @@ class Database:
         # Iterates over the keys
         for key in tqdm.tqdm(fil.keys()):
             # Link inputs to outputs
-            for pth, out in zip([self.train_pth, self.valid_pth], 
+            for pth, out in zip([self.train_pth, self.valid_pth],
                                 [self.train_out, self.valid_out]):
-                # Load the values
-                with h5py.File(pth, 'r') as dtb: val = dtb[key].value
-
-                # Apply the kalman filter if needed
-                if fil[key]:
-                    pol = multiprocessing.Pool(processes=self.threads)
-                    arg = {'std_factor': dic[key][0], 'smooth_window': dic[key][1]}
-                    fun = partial(kalman_filter, **arg)
-                    val = np.asarray(pol.map(fun, val))
-                    pol.close()
-                    pol.join()
-
-                # Serialize the outputs
-                with h5py.File(out, 'a') as dtb:
-                    if dtb.get(key): del dtb[key]
-                    dtb.create_dataset(key, data=val)
 
-                # Memory efficiency
-                del val
+                with h5py.File(pth, 'r') as dtb: shp = dtb[key].shape
+                with h5py.File(out, 'a') as dtb: self.allocate(dtb, key, shp)
+
+                for beg, end in self.chunks(shp[0]):
+
+                    # Apply the kalman filter if needed
+                    if fil[key]:
+                        arg = {'std_factor': dic[key][0], 'smooth_window': dic[key][1]}
+                        val = self.apply(partial(kalman_filter_batch, **arg), self.load(pth, key, beg, end), batch=True)
+                    else:
+                        with h5py.File(pth, 'r') as dtb: val = dtb[key][beg:end]
+
+                    # Serialize the outputs
+                    with h5py.File(out, 'a') as dtb: dtb[key][beg:end] = val
+
+                    # Memory efficiency
+                    del val
 
     # Rescale the datasets considering both training and validation
     def rescale(self, size=2000):
@@ -354,7 +967,10 @@ class Database:
         with h5py.File(self.train_sca, 'a') as dtb:
             if dtb.get('lab'): del dtb['lab']
             with h5py.File(self.train_out, 'r') as inp:
-                dtb.create_dataset('lab', data=inp['lab'].value)
+                h5_dataset(dtb, 'lab', data=inp['lab'].value, **self.layout)
+
+        # Links the intermediary datasets to the scaled ones
+        lnk = [(self.train_out, self.train_sca), (self.valid_out, self.valid_sca)]
 
         # Rescale the time series
         for key in tqdm.tqdm(eeg + res):
@@ -362,83 +978,86 @@ class Database:
             # Define the scalers
             mms = MinMaxScaler(feature_range=(-1,1))
             sts = StandardScaler(with_std=False)
-            
-            with h5py.File(self.train_out, 'r') as dtb:
-                pol = multiprocessing.Pool(processes=self.threads)
-                fun = partial(resize_time_serie, size=size, log=False)
-                n_t = np.vstack(tuple(pol.map(fun, dtb[key].value)))
-                pol.close()
-                pol.join()
-
-            with h5py.File(self.valid_out, 'r') as dtb:
-                pol = multiprocessing.Pool(processes=self.threads)
-                fun = partial(resize_time_serie, size=size, log=False)
-                n_v = np.vstack(tuple(pol.map(fun, dtb[key].value)))
-                pol.close()
-                pol.join()
-
-            # Fit the scalers
-            mms.fit(np.hstack(np.vstack((n_t, n_v))).reshape(-1,1))
-            sts.fit(mms.transform(np.hstack(tuple(n_t)).reshape(-1,1)))
+            fun = partial(resize_time_serie, size=size, log=False)
+
+            # Resize the time series and fit the range
+            for inp, out in lnk:
+
+                with h5py.File(inp, 'r') as dtb: num = dtb[key].shape[0]
+                with h5py.File(out, 'a') as dtb: self.allocate(dtb, key, (num, size))
+
+                for beg, end in self.chunks(num):
+                    val = self.apply(fun, self.load(inp, key, beg, end))
+                    mms.partial_fit(val.reshape(-1,1))
+                    with h5py.File(out, 'a') as dtb: dtb[key][beg:end] = val
+
+            # Fit the centering on the training set only
+            with h5py.File(self.train_sca, 'r') as dtb: num = dtb[key].shape[0]
+            for beg, end in self.chunks(num):
+                with h5py.File(self.train_sca, 'r') as dtb: val = dtb[key][beg:end]
+                sts.partial_fit(mms.transform(val.reshape(-1,1)))
+
             pip = Pipeline([('mms', mms), ('sts', sts)])
-            
-            with h5py.File(self.train_sca, 'a') as dtb: 
-                if dtb.get(key): del dtb[key]
-                dtb.create_dataset(key, data=pip.transform(np.hstack(tuple(n_t)).reshape(-1,1)).reshape(n_t.shape))
-            with h5py.File(self.valid_sca, 'a') as dtb:
-                if dtb.get(key): del dtb[key]
-                dtb.create_dataset(key, data=pip.transform(np.hstack(tuple(n_v)).reshape(-1,1)).reshape(n_v.shape))
-            
+
+            # Apply the scaling
+            for _, out in lnk:
+                with h5py.File(out, 'a') as dtb:
+                    for beg, end in self.chunks(dtb[key].shape[0]):
+                        val = dtb[key][beg:end]
+                        dtb[key][beg:end] = pip.transform(val.reshape(-1,1)).reshape(val.shape)
+
             # Memory efficiency
-            del mms, sts, pip, n_t, n_v
+            del mms, sts, pip, val
 
         # Rescaling for the betti curves
         for key in tqdm.tqdm(unt):
 
-            try: 
+            try:
                 # Defines the scalers
                 mms = MinMaxScaler(feature_range=(0,1))
 
-                for pth in [self.train_out, self.valid_out]:
+                for pth, _ in lnk:
                     with h5py.File(pth, 'r') as dtb:
-                        mms.partial_fit(np.hstack(dtb[key].value).reshape(-1,1))
+                        for beg, end in self.chunks(dtb[key].shape[0]):
+                            mms.partial_fit(dtb[key][beg:end].reshape(-1,1))
 
-                for inp, out in [(self.train_out, self.train_sca), (self.valid_out, self.valid_sca)]:
+                for inp, out in lnk:
 
-                    with h5py.File(inp, 'r') as dtb:
-                        shp = dtb[key].shape
-                        tmp = np.hstack(dtb[key].value).reshape(-1,1)
-                        res = mms.transform(tmp).reshape(shp)
+                    with h5py.File(inp, 'r') as dtb: shp = dtb[key].shape
+                    with h5py.File(out, 'a') as dtb: self.allocate(dtb, key, shp)
 
-                    with h5py.File(out, 'a') as dtb:
-                        if dtb.get(key): del dtb[key]
-                        dtb.create_dataset(key, data=res)
+                    for beg, end in self.chunks(shp[0]):
+                        with h5py.File(inp, 'r') as dtb: val = dtb[key][beg:end]
+                        with h5py.File(out, 'a') as dtb:
+                            dtb[key][beg:end] = mms.transform(val.reshape(-1,1)).reshape(val.shape)
 
                 # Memory efficiency
-                del mms, tmp
+                del mms, val
 
             except: pass
-        
+
         # Rescaling for the persistent landscapes
         for key in tqdm.tqdm(ldc):
 
-            try: 
+            try:
                 m_x = []
 
-                for pth in [self.train_out, self.valid_out]:
+                for pth, _ in lnk:
                     # Defines the maximum value for all landscapes
                     with h5py.File(pth, 'r') as dtb:
-                        m_x.append(np.max(dtb[key].value))
+                        for beg, end in self.chunks(dtb[key].shape[0]):
+                            m_x.append(np.max(dtb[key][beg:end]))
 
                 m_x = max(tuple(m_x))
 
-                for inp, out in [(self.train_out, self.train_sca), (self.valid_out, self.valid_sca)]:
+                for inp, out in lnk:
 
-                    with h5py.File(inp, 'r') as dtb:
-                        val = dtb[key].value / m_x
-                    with h5py.File(out, 'a') as dtb:
-                        if dtb.get(key): del dtb[key]
-                        dtb.create_dataset(key, data=val)
+                    with h5py.File(inp, 'r') as dtb: shp = dtb[key].shape
+                    with h5py.File(out, 'a') as dtb: self.allocate(dtb, key, shp)
+
+                    for beg, end in self.chunks(shp[0]):
+                        with h5py.File(inp, 'r') as dtb: val = dtb[key][beg:end] / m_x
+                        with h5py.File(out, 'a') as dtb: dtb[key][beg:end] = val
                         del val
 
             except: pass
@@ -449,25 +1068,31 @@ class Database:
             # Build the scaler
             mms = MinMaxScaler(feature_range=(-1,1))
             sts = StandardScaler(with_std=False)
+            # Non-finite values are replaced by the column means of their file
+            mea = {inp: self.column_means(inp, key) for inp, _ in lnk}
 
-            for pth in [self.train_out, self.valid_out]:
+            for pth, _ in lnk:
                 # Partial fit for both training and validation
                 with h5py.File(pth, 'r') as dtb:
-                    mms.partial_fit(remove_out_with_mean(dtb[key].value))
+                    for beg, end in self.chunks(dtb[key].shape[0]):
+                        mms.partial_fit(remove_out_with_mean(dtb[key][beg:end], mea=mea[pth]))
 
             # Partial fit for both training and validation
             with h5py.File(self.train_out, 'r') as dtb:
-                sts.partial_fit(mms.transform(remove_out_with_mean(dtb[key].value)))
+                for beg, end in self.chunks(dtb[key].shape[0]):
+                    sts.partial_fit(mms.transform(remove_out_with_mean(dtb[key][beg:end], mea=mea[self.train_out])))
 
             pip = Pipeline([('mms', mms), ('sts', sts)])
 
-            for inp, out in [(self.train_out, self.train_sca), (self.valid_out, self.valid_sca)]:
+            for inp, out in lnk:
 
-                with h5py.File(inp, 'r') as dtb:
-                    val = pip.transform(remove_out_with_mean(dtb[key].value))
-                with h5py.File(out, 'a') as dtb:
-                    if dtb.get(key): del dtb[key]
-                    dtb.create_dataset(key, data=val)
+                with h5py.File(inp, 'r') as dtb: shp = dtb[key].shape
+                with h5py.File(out, 'a') as dtb: self.allocate(dtb, key, shp)
+
+                for beg, end in self.chunks(shp[0]):
+                    with h5py.File(inp, 'r') as dtb:
+                        val = pip.transform(remove_out_with_mean(dtb[key][beg:end], mea=mea[inp]))
+                    with h5py.File(out, 'a') as dtb: dtb[key][beg:end] = val
                     del val
 
     # Defines a way to reduce the problem
@@ -485,7 +1110,7 @@ class Database:
 
                 for key in tqdm.tqdm(list(inp.keys())):
                     # Iterated serialization of the key component
-                    out.create_dataset(key, data=inp[key].value[idx])
+                    h5_dataset(out, key, data=inp[key].value[idx], **self.layout)
 
     # Defines both training and testing instances
     # output refers to where to put the data
@@ -506,9 +1131,9 @@ class Database:
 
                     lab_t, lab_e = '{}_t'.format(key), '{}_e'.format(key)
                     if out.get(lab_t): del out[lab_t]
-                    out.create_dataset(lab_t, data=dtb[key].value[i_t])
+                    h5_dataset(out, lab_t, data=dtb[key].value[i_t], **self.layout)
                     if out.get(lab_e): del out[lab_e]
-                    out.create_dataset(lab_e, data=dtb[key].value[i_e])
+                    h5_dataset(out, lab_e, data=dtb[key].value[i_e], **self.layout)
 
         # Adds the validation set into the output database
         with h5py.File(self.valid_sca, 'r') as dtb:
@@ -519,12 +1144,13 @@ class Database:
 
                     lab_v = '{}_v'.format(key)
                     if out.get(lab_v): del out[lab_v]
-                    out.create_dataset(lab_v, data=dtb[key].value)
+                    h5_dataset(out, lab_v, data=dtb[key].value, **self.layout)
     
     # Build the multiple datasets necessary for cross-validation
     # folds refers to the amount of cross-validation rounds
     # storage refers to the root directory for datasets storage
-    def build_cv(self, folds, storage='./dataset'):
+    # virtual refers whether to store only the indexes of the folds, read through open_fold
+    def build_cv(self, folds, storage='./dataset', virtual=False):
 
         with h5py.File(self.train_sca, 'r') as dtb: 
             lab = dtb['lab'].value.ravel()
@@ -539,6 +1165,18 @@ class Database:
             output = '{}/CV_ITER_{}.h5'.format(storage, idx)
             print('\n# Building CV_ITER_{}.h5'.format(idx))
 
+            # Only the indexes refer to the scaled files
+            if virtual:
+
+                with h5py.File(output, 'w') as out:
+                    out.attrs['virtual'] = True
+                    out.attrs['train'] = os.path.abspath(self.train_sca)
+                    out.attrs['valid'] = os.path.abspath(self.valid_sca)
+                    out.create_dataset('idx_t', data=i_t)
+                    out.create_dataset('idx_e', data=i_e)
+
+                continue
+
             # Split the training set into both training and testing
             with h5py.File(self.train_sca, 'r') as dtb:
 
@@ -549,9 +1187,9 @@ class Database:
                     with h5py.File(output, 'a') as out:
                         key_t, key_e = '{}_t'.format(key), '{}_e'.format(key)
                         if out.get(key_t): del out[key_t]
-                        out.create_dataset(key_t, data=dtb[key].value[i_t])
+                        h5_dataset(out, key_t, data=dtb[key].value[i_t], **self.layout)
                         if out.get(key_e): del out[key_e]
-                        out.create_dataset(key_e, data=dtb[key].value[i_e])
+                        h5_dataset(out, key_e, data=dtb[key].value[i_e], **self.layout)
 
             # Adds the validation set into the output database
             with h5py.File(self.valid_sca, 'r') as dtb:
@@ -563,7 +1201,7 @@ class Database:
                     with h5py.File(output, 'a') as out:
                         key_v = '{}_v'.format(key)
                         if out.get(key_v): del out[key_v]
-                        out.create_dataset(key_v, data=dtb[key].value)
+                        h5_dataset(out, key_v, data=dtb[key].value, **self.layout)
 
         # Serialize the corresponding indexes
         with open('{}/CV_DISTRIB.pk'.format(storage), 'wb') as raw:
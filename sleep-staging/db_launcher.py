@@ -15,16 +15,18 @@ if __name__ == '__main__':
     # Mandatory arguments
     prs.add_argument('-s', '--size', help='Interpolation size', type=int, default=2000)
     prs.add_argument('-t', '--threads', help='Number of concurrent threads', type=int, default=multiprocessing.cpu_count())
+    prs.add_argument('-c', '--chunk', help='Rows loaded at once', type=int, default=4096)
     # Parse the arguments
     prs = prs.parse_args()
 
     # Rename the keys for further processing
     rename(storage='./dataset')
     # Launch the datasets construction
-    dtb = Database(threads=prs.threads)
+    dtb = Database(threads=prs.threads, chunk=prs.chunk)
     dtb.load_labels()
     dtb.unshift()
     dtb.add_norm_acc()
     dtb.add_norm_eeg()
     # Compute the features
     dtb.add_features()
+    dtb.close()
@@ -0,0 +1,80 @@
+# Dreem Headband Sleep Phases Classification Challenge
+# Batched seasonal decomposition and autoregressive coefficients
+
+try: from package.toolbox import *
+except: from toolbox import *
+
+# Moving-average filter used by seasonal_decompose for the trend
+# freq refers to the period of the seasonality
+
+def trend_filter(freq):
+
+    if freq % 2 == 0: return np.array([0.5] + [1.0]*(freq-1) + [0.5]) / freq
+    else: return np.repeat(1.0 / freq, freq)
+
+# Additive seasonal decomposition of all the rows at once
+# Reproduces seasonal_decompose(row, model='additive', freq=freq) row by row
+# mat refers to a 2D array of epochs, one per row
+# freq refers to the period of the seasonality
+
+def seasonal_decompose_batch(mat, freq):
+
+    mat = np.asarray(mat, dtype='float64')
+    if not np.isfinite(mat).all(): raise ValueError('This function does not handle missing values')
+
+    num, lth = mat.shape
+    fil = trend_filter(freq)
+    hlf = len(fil) // 2
+
+    # Centered moving average, undefined on the borders
+    trd = np.full(mat.shape, np.nan)
+    trd[:,hlf:lth-hlf] = sg.convolve(mat, fil[None,:], mode='valid')
+    dtr = mat - trd
+
+    # Average of each phase over the periods
+    per = int(np.ceil(lth / freq))
+    tmp = np.full((num, per*freq), np.nan)
+    tmp[:,:lth] = dtr
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        avg = np.nanmean(tmp.reshape(num, per, freq), axis=1)
+    avg -= np.mean(avg, axis=1)[:,None]
+
+    sea = np.tile(avg, (1, per))[:,:lth]
+    rsd = dtr - sea
+
+    # Memory efficiency
+    del tmp, dtr, avg
+
+    return trd, sea, rsd
+
+# Lag order chosen by AR.fit when none is given
+# nobs refers to the length of the series
+
+def ar_order(nobs):
+
+    return int(round(12 * (nobs / 100.0)**(1 / 4.0)))
+
+# Conditional least-squares AR coefficients of all the rows at once
+# Reproduces AR(row).fit().params, constant first, for rows of equal length
+# mat refers to a 2D array of series, one per row
+# batch_size refers to the amount of rows solved at once
+
+def ar_coefficients_batch(mat, batch_size=64):
+
+    mat = np.asarray(mat, dtype='float64')
+    lag = ar_order(mat.shape[1])
+
+    # Lagged design, constant then lags 1 to lag
+    idx = np.arange(lag, mat.shape[1])[:,None] - np.arange(1, lag+1)[None,:]
+    res = np.empty((len(mat), lag+1))
+
+    for beg in range(0, len(mat), batch_size):
+        val = mat[beg:beg+batch_size]
+        des = np.ones((len(val), idx.shape[0], lag+1))
+        des[:,:,1:] = val[:,idx]
+        # Least-squares through stacked pseudo-inverses, as OLS does
+        res[beg:beg+batch_size] = np.matmul(np.linalg.pinv(des), val[:,lag:,None])[:,:,0]
+        del des
+
+    return res
@@ -5,6 +5,77 @@
 try: from package.toolbox import *
 except: from toolbox import *
 
+# Sliding windows along the first axis, as a strided view without any copy
+# arr refers to the array to window
+# size refers to the length of the windows
+# amount refers to the amount of windows, all of them by default
+
+def sliding_windows(arr, size, amount=None):
+
+    if amount is None: amount = max(arr.shape[0] - size + 1, 0)
+    shp = (amount, size) + arr.shape[1:]
+    std = (arr.strides[0],) + arr.strides
+
+    return np.lib.stride_tricks.as_strided(arr, shape=shp, strides=std, writeable=False)
+
+# Builds the LSTM predicting the next label of a hypnogram
+# timesteps refers to the length of the observed history
+# n_c refers to the amount of sleep phases
+
+def lstm_labels(timesteps, n_c=5):
+
+    model = Sequential()
+    model.add(LSTM(5*timesteps, input_shape=(timesteps, n_c), return_sequences=True))
+    model.add(Dropout(0.5))
+    model.add(LSTM(timesteps, return_sequences=True))
+    model.add(Dropout(0.5))
+    model.add(LSTM(timesteps, return_sequences=True))
+    model.add(Dropout(0.5))
+    model.add(LSTM(timesteps, return_sequences=False))
+    model.add(Dropout(0.5))
+    model.add(Dense(n_c, activation='softmax'))
+
+    return model
+
+# Hypnogram smoothing, keeping the LSTM loaded across the recordings
+
+class Smoother:
+
+    # Initialization
+    # save refers to the weights saved by Profiles.learn
+    # timesteps refers to the length of the observed history
+    # n_c refers to the amount of sleep phases
+    def __init__(self, save='./models/lstm_labels.ks', timesteps=20, n_c=5):
+
+        self.tms = timesteps
+        self.n_c = n_c
+        self.model = lstm_labels(timesteps, n_c)
+        self.model.load_weights(save)
+
+    # Smooths many recordings through a single batched prediction
+    # profiles refers to a list of label sequences, one per night
+    # batch refers to the batch size of the prediction
+    def smooth(self, profiles, batch=4096):
+
+        lth = [len(ele) for ele in profiles]
+        off = np.concatenate(([0], np.cumsum(lth))).astype(int)
+        # One-hot encoding of all the nights, back to back
+        hot = np.zeros((off[-1], self.n_c), dtype='float32')
+        if off[-1] > 0: hot[np.arange(off[-1]), np.concatenate(profiles).astype(int)] = 1.0
+
+        # Windows overlapping two nights are computed but never used
+        num = max(off[-1] - self.tms, 0)
+        if num == 0: return [np.zeros(ele) for ele in lth]
+        prd = np.argmax(self.model.predict(sliding_windows(hot, self.tms, num), batch_size=batch), axis=1)
+
+        res = []
+        for beg, sze in zip(off[:-1], lth):
+            out = np.zeros(sze)
+            if sze > self.tms: out[self.tms:] = prd[beg:beg+sze-self.tms]
+            res.append(out)
+
+        return res
+
 # Develops a class relative to profile extraction
 
 class Profiles:
@@ -14,6 +85,8 @@ class Profiles:
         try: self.lab = labels.values.ravel()
         except: self.lab = labels.ravel()
 
+        self.smoothers = dict()
+
     def ratios(self):
 
         prp = [len(np.where(self.lab == idx)[0]) / len(self.lab) for idx in np.unique(self.lab)]
@@ -61,28 +134,17 @@ class Profiles:
 
         vec = []
 
-        # Decompose the profiles into learning timesteps
+        # Decompose the profiles into learning timesteps, as views of their one-hot encoding
         for profile in profiles:
-            m_i = np.arange(timesteps+1)*(0+1)
-            m_j = np.arange(np.max(profile.shape[0]-(timesteps)*(0+1), 0))
-            vec.append(profile[m_i + m_j.reshape(-1,1)])
-        # Categorical transformation
-        vec = np_utils.to_categorical(np.vstack(tuple(vec)))
+            hot = np_utils.to_categorical(profile, num_classes=5)
+            vec.append(sliding_windows(hot, timesteps+1))
+        vec = np.vstack(tuple(vec))
         x,y = vec[:,:timesteps,:], vec[:,-1,:]
         # Train test separation
         x_t, x_v, y_t, y_v = train_test_split(x, y, test_size=test_size, shuffle=True)
 
         # Build the LSTM model
-        model = Sequential()
-        model.add(LSTM(5*timesteps, input_shape=(x_t.shape[1], x_t.shape[2]), return_sequences=True))
-        model.add(Dropout(0.5))
-        model.add(LSTM(timesteps, return_sequences=True))
-        model.add(Dropout(0.5))
-        model.add(LSTM(timesteps, return_sequences=True))
-        model.add(Dropout(0.5))
-        model.add(LSTM(timesteps, return_sequences=False))
-        model.add(Dropout(0.5))
-        model.add(Dense(5, activation='softmax'))
+        model = lstm_labels(timesteps, 5)
         model.compile(loss='categorical_crossentropy', optimizer='adadelta', metrics=['accuracy'])
 
         # Defines the callbacks
@@ -95,17 +157,20 @@ class Profiles:
         model.fit(x_t, y_t, epochs=epochs, batch_size=32, shuffle=True, 
                   callbacks=[early, check], validation_data=(x_v, y_v))
 
+    # Smooths the predictions of a single night
+    # prd refers to either a (n, n_c) array of one-hot encodings or probabilities, or to n labels
+    # save refers to the weights of the smoothing LSTM
+    # timesteps refers to the size of the windows it was trained on
     def smooth_output(self, prd, save='./models/lstm_labels.ks', timesteps=20):
 
-        # Build the embedding
-        m_i = np.arange(timesteps)*(0+1)
-        m_j = np.arange(np.max(prd.shape[0]-(timesteps)*(0+1), 0))
-        x_v = prd[m_i + m_j.reshape(-1,1)]
-        # Make the predictions
-        model = load_model(save)
-        prd = model.predict(x_v)
+        prd = np.asarray(prd)
+        if prd.ndim == 2: prd = np.argmax(prd, axis=1)
+        elif prd.ndim != 1: raise ValueError('Expected (n, n_c) predictions or n labels, got shape {}'.format(prd.shape))
+
+        # The smoother is loaded once per weights file
+        if (save, timesteps) not in self.smoothers: self.smoothers[(save, timesteps)] = Smoother(save, timesteps)
 
-        return np.hstack((np.zeros(timesteps), np.argmax(prd, axis=1)))
+        return self.smoothers[(save, timesteps)].smooth([prd])[0]
 
 # Detect anomalies
 
@@ -6,6 +6,80 @@ from package.database import *
 from package.callback import *
 from package.ds_model import *
     
+# Batches of a fold as a keras Sequence, safe with several workers
+# Each process opens its own reader, whose rotating buffers outlive the queue of keras
+
+class FoldSequence(Sequence):
+
+    # Initialization
+    # pth refers to the fold file
+    # entries refers to the keys feeding the inputs
+    # labels refers to the labels of the rows
+    # n_c refers to the amount of classes of the model, whatever the classes of the split
+    # fmt refers to the suffix of the keys
+    # mrg_size refers to the size of the merge layer, targeted by the decoder
+    # batch refers to the batch size
+    # partial refers whether to keep the last incomplete batch
+    # depth refers to the amount of buffers in rotation
+    # shuffle refers whether to read the rows along a permutation renewed at each epoch
+    # windows refers to the amount of batches per shuffling window, aligned on the chunks
+    def __init__(self, pth, entries, labels, n_c, fmt, mrg_size, batch=64, partial=False, depth=32, shuffle=False, windows=8):
+
+        self.pth = pth
+        self.ent = entries + ['lab_{}'.format(fmt)]
+        self.n_c = n_c
+        self.num = len(labels)
+        self.batch = batch
+        self.partial = partial
+        self.depth = depth
+        self.nul = np.zeros((batch, mrg_size), dtype='float32')
+        self.lock = threading.Lock()
+        self.rdr, self.pid = None, None
+        self.window = windows * batch
+        self.prm = self.permutation() if shuffle else None
+
+    def __len__(self):
+
+        if self.partial: return int(np.ceil(self.num / self.batch))
+        else: return self.num // self.batch
+
+    # Reads a batch, with its one-hot labels
+    # idx refers to the index of the batch
+    def __getitem__(self, idx):
+
+        ind = idx * self.batch
+
+        with self.lock:
+            if self.pid != os.getpid(): self.rdr, self.pid = BatchReader(self.pth, self.ent, self.batch, depth=self.depth), os.getpid()
+            if self.prm is None: vec = self.rdr.read(ind, min(self.batch, self.num - ind))
+            else: vec = self.rdr.gather(self.prm[ind:ind+self.batch])
+
+        lab = vec.pop()
+        lab = np.eye(self.n_c, dtype='float32')[lab.ravel().astype(int)]
+
+        return vec, [lab, self.nul[:len(lab)]]
+
+    # Shuffles the order of the windows, then the rows inside each window
+    # Consecutive batches thus hit the same chunks, kept in the cache of h5py
+    def permutation(self):
+
+        win = np.arange(self.num) // self.window
+        rnk = np.random.permutation(win[-1] + 1)[win] if self.num > 0 else win
+
+        return np.lexsort((np.random.rand(self.num), rnk))
+
+    # Draws a new permutation, without any write to the fold
+    def on_epoch_end(self):
+
+        if self.prm is not None:
+            with self.lock: self.prm = self.permutation()
+
+    # Releases the reader, reopened at the next batch
+    def close(self):
+
+        if self.rdr is not None: self.rdr.close()
+        self.rdr, self.pid = None, None
+
 # Defines the multi-channel networks
 
 class DL_Model:
@@ -28,222 +102,48 @@ class DL_Model:
         if marker: self.his = './models/HIS_{}.history'.format(marker)
         else: self.his = './models/HIS.history'
         # Handling labels
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             self.l_t = dtb['lab_t'].value.ravel()
             self.l_e = dtb['lab_e'].value.ravel()
             self.n_c = len(np.unique(self.l_t))
 
-    # Defines a generator (training and testing)
-    # fmt refers to whether apply it for training or testing
-    # batch refers to the batch size
-    def data_gen(self, fmt, mrg_size, batch=64):
-        
-        ind = 0
-
-        while True :
-            
-            if fmt == 't': ann = self.l_t
-            if fmt == 'e': ann = self.l_e
-            # Reinitialize when going too far
-            if ind + batch >= len(ann) : ind = 0
-            # Initialization of data vector
-            vec = []
-
-            if self.cls['with_acc_cv2']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    shp = dtb['acc_x_{}'.format(fmt)].shape
-                    tmp = np.empty((batch, 3, shp[1]))
-                    for idx, mkr in zip(range(3), ['x', 'y', 'z']):
-                        key = 'acc_{}_{}'.format(mkr, fmt)
-                        tmp[:,idx,:] = dtb[key][ind:ind+batch]
-                    vec.append(tmp)
-                    del shp, tmp, key
-
-            if self.cls['with_acc_cv1'] or self.cls['with_acc_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['acc_x', 'acc_y', 'acc_z']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_n_a_cv1'] or self.cls['with_n_a_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['norm_acc_{}'.format(fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_cv2']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    shp = dtb['eeg_1_{}'.format(fmt)].shape
-                    tmp = np.empty((batch, 4, shp[1]))
-                    for idx in range(4):
-                        key = 'eeg_{}_{}'.format(idx+1, fmt)
-                        tmp[:,idx,:] = dtb[key][ind:ind+batch]
-                    vec.append(tmp)
-                    del shp, tmp, key
-
-            boo = self.cls['with_eeg_enc'] or self.cls['with_eeg_ate']
-            if self.cls['with_eeg_cv1'] or self.cls['with_eeg_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_tda']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['bup_1', 'bup_2', 'bup_3', 'bup_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_l_0']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['l_0_1', 'l_0_2', 'l_0_3', 'l_0_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_l_1']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['l_1_1', 'l_1_2', 'l_1_3', 'l_1_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_n_e_cv1'] or self.cls['with_n_e_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['norm_eeg_{}'.format(fmt)][ind:ind+batch])
-
-            boo = self.cls['with_por_enc'] or self.cls['with_por_ate']
-            if self.cls['with_por_cv1'] or self.cls['with_por_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['po_r_{}'.format(fmt)][ind:ind+batch])
-
-            boo = self.cls['with_poi_enc'] or self.cls['with_poi_ate']
-            if self.cls['with_poi_cv1'] or self.cls['with_poi_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['po_ir_{}'.format(fmt)][ind:ind+batch])
-
-            if self.cls['with_fea']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['fea_{}'.format(fmt)][ind:ind+batch])
-
-            with h5py.File(self.pth, 'r') as dtb:
-
-                # Defines the labels
-                lab = dtb['lab_{}'.format(fmt)][ind:ind+batch]
-                lab = np_utils.to_categorical(lab, num_classes=self.n_c)
-                lab = [lab, np.zeros((len(lab), mrg_size)).astype('float32')]
-            
-            yield(vec, lab)
-            del lab, vec
-
-            ind += batch
-
-    # Defines a generator (testing and validation)
-    # fmt refers to whether apply it for testing or validation
-    # batch refers to the batch size
-    def data_val(self, fmt, batch=512):
-
-        if fmt == 'e':
-            sze = len(self.l_e)
-        if fmt == 'v':
-            with h5py.File(self.pth, 'r') as dtb: sze = dtb['eeg_1_v'].shape[0]
-
-        ind, poi = 0, sze
-
-        while True :
-            
-            # Reinitialize when going too far
-            if ind > sze : ind, poi = 0, sze
-            # Initialization of data vector
-            vec = []
-
-            if self.cls['with_acc_cv2']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    shp = dtb['acc_x_{}'.format(fmt)].shape
-                    tmp = np.empty((min(poi, batch), 3, shp[1]))
-                    for idx, mkr in zip(range(3), ['x', 'y', 'z']):
-                        key = 'acc_{}_{}'.format(mkr, fmt)
-                        tmp[:,idx,:] = dtb[key][ind:ind+batch]
-                    vec.append(tmp)
-                    del shp, tmp, key
-
-            if self.cls['with_acc_cv1'] or self.cls['with_acc_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['acc_x', 'acc_y', 'acc_z']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_n_a_cv1'] or self.cls['with_n_a_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['norm_acc_{}'.format(fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_cv2']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    shp = dtb['eeg_1_{}'.format(fmt)].shape
-                    tmp = np.empty((min(poi, batch), 4, shp[1]))
-                    for idx in range(4):
-                        ann = 'eeg_{}_{}'.format(idx+1, fmt)
-                        tmp[:,idx,:] = dtb[ann][ind:ind+batch]
-                    vec.append(tmp)
-                    del shp, tmp, ann
-
-            boo = self.cls['with_eeg_enc'] or self.cls['with_eeg_ate']
-            if self.cls['with_eeg_cv1'] or self.cls['with_eeg_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_tda']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['bup_1', 'bup_2', 'bup_3', 'bup_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_l_0']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['l_0_1', 'l_0_2', 'l_0_3', 'l_0_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_eeg_l_1']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    for key in ['l_1_1', 'l_1_2', 'l_1_3', 'l_1_4']:
-                        vec.append(dtb['{}_{}'.format(key, fmt)][ind:ind+batch])
-
-            if self.cls['with_n_e_cv1'] or self.cls['with_n_e_cvl']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['norm_eeg_{}'.format(fmt)][ind:ind+batch])
-
-            boo = self.cls['with_por_enc'] or self.cls['with_por_ate']
-            if self.cls['with_por_cv1'] or self.cls['with_por_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['po_r_{}'.format(fmt)][ind:ind+batch])
-
-            boo = self.cls['with_poi_enc'] or self.cls['with_poi_ate']
-            if self.cls['with_poi_cv1'] or self.cls['with_poi_cvl'] or boo:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['po_ir_{}'.format(fmt)][ind:ind+batch])
-
-            if self.cls['with_fea']:
-
-                with h5py.File(self.pth, 'r') as dtb:
-                    vec.append(dtb['fea_{}'.format(fmt)][ind:ind+batch])
-
-            yield(vec)
+    # Keys feeding the inputs of the channels, in the order of the inputs
+    # Tuples of keys are stacked along the second axis
+    # fmt refers to the suffix of the keys
+    def batch_keys(self, fmt):
+
+        res = []
+        fun = lambda lst: ['{}_{}'.format(key, fmt) for key in lst]
+
+        if self.cls['with_acc_cv2']:
+            res.append(tuple(fun(['acc_x', 'acc_y', 'acc_z'])))
+        if self.cls['with_acc_cv1'] or self.cls['with_acc_cvl']:
+            res += fun(['acc_x', 'acc_y', 'acc_z'])
+        if self.cls['with_n_a_cv1'] or self.cls['with_n_a_cvl']:
+            res += fun(['norm_acc'])
+        if self.cls['with_eeg_cv2']:
+            res.append(tuple(fun(['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4'])))
+        boo = self.cls['with_eeg_enc'] or self.cls['with_eeg_ate']
+        if self.cls['with_eeg_cv1'] or self.cls['with_eeg_cvl'] or boo:
+            res += fun(['eeg_1', 'eeg_2', 'eeg_3', 'eeg_4'])
+        if self.cls['with_eeg_tda']:
+            res += fun(['bup_1', 'bup_2', 'bup_3', 'bup_4'])
+        if self.cls['with_eeg_l_0']:
+            res += fun(['l_0_1', 'l_0_2', 'l_0_3', 'l_0_4'])
+        if self.cls['with_eeg_l_1']:
+            res += fun(['l_1_1', 'l_1_2', 'l_1_3', 'l_1_4'])
+        if self.cls['with_n_e_cv1'] or self.cls['with_n_e_cvl']:
+            res += fun(['norm_eeg'])
+        boo = self.cls['with_por_enc'] or self.cls['with_por_ate']
+        if self.cls['with_por_cv1'] or self.cls['with_por_cvl'] or boo:
+            res += fun(['po_r'])
+        boo = self.cls['with_poi_enc'] or self.cls['with_poi_ate']
+        if self.cls['with_poi_cv1'] or self.cls['with_poi_cvl'] or boo:
+            res += fun(['po_ir'])
+        if self.cls['with_fea']:
+            res += fun(['fea'])
 
-            ind += batch
-            poi -= batch
+        return res
 
     # Adds a 2D-Convolution Channel
     # inp refers to the defined input
@@ -506,7 +406,7 @@ class DL_Model:
         # Layer arguments
         arg = {'kernel_initializer': 'he_uniform'}
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             if self.cls['with_acc_cv2']:
                 inp = Input(shape=(3, dtb['acc_x_t'].shape[1]))
                 self.add_CONV2D(inp, self.drp, arg)
@@ -515,12 +415,12 @@ class DL_Model:
                 if self.cls['with_acc_cv1']: self.add_CONV1D(inp, key[:-2], self.drp, arg)
                 if self.cls['with_acc_cvl']: self.add_CVLSTM(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             inp = Input(shape=(dtb['norm_acc_t'].shape[1], ))
             if self.cls['with_n_a_cv1']: self.add_CONV1D(inp, 'norm_acc', self.drp, arg)
             if self.cls['with_n_a_cvl']: self.add_CVLSTM(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             if self.cls['with_eeg_cv2']:
                 inp = Input(shape=(4, dtb['eeg_1_t'].shape[1]))
                 self.add_CONV2D(inp, self.drp, arg)
@@ -531,37 +431,37 @@ class DL_Model:
                 if self.cls['with_eeg_enc']: self.add_ENCODE(inp, key[:-2], self.drp, arg)
                 if self.cls['with_eeg_ate']: self.add_ATENCO(inp, key[:-2], self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             if self.cls['with_eeg_tda']:
                 for key in ['bup_1_t', 'bup_2_t', 'bup_3_t', 'bup_4_t']:
                     inp = Input(shape=(dtb[key].shape[1], ))
                     self.add_TDACV1(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             if self.cls['with_eeg_l_0']:
                 for key in ['l_0_1_t', 'l_0_2_t', 'l_0_3_t', 'l_0_4_t']:
                     inp = Input(shape=(dtb[key].shape[1], dtb[key].shape[2]))
                     self.add_SILHOU(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             if self.cls['with_eeg_l_1']:
                 for key in ['l_1_1_t', 'l_1_2_t', 'l_1_3_t', 'l_1_4_t']:
                     inp = Input(shape=(dtb[key].shape[1], dtb[key].shape[2]))
                     self.add_SILHOU(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             inp = Input(shape=(dtb['norm_eeg_t'].shape[1], ))
             if self.cls['with_n_e_cv1']: self.add_CONV1D(inp, 'norm_eeg', self.drp, arg)
             if self.cls['with_n_e_cvl']: self.add_CVLSTM(inp, self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             inp = Input(shape=(dtb['po_r_t'].shape[1], ))
             if self.cls['with_por_cv1']: self.add_CONV1D(inp, 'po_r', self.drp, arg)
             if self.cls['with_por_cvl']: self.add_CVLSTM(inp, self.drp, arg)
             if self.cls['with_por_enc']: self.add_ENCODE(inp, 'po_r', self.drp, arg)
             if self.cls['with_por_ate']: self.add_ATENCO(inp, 'po_r', self.drp, arg)
 
-        with h5py.File(self.pth, 'r') as dtb:
+        with open_fold(self.pth) as dtb:
             inp = Input(shape=(dtb['po_ir_t'].shape[1], ))
             if self.cls['with_poi_cv1']: self.add_CONV1D(inp, 'po_ir', self.drp, arg)
             if self.cls['with_poi_cvl']: self.add_CVLSTM(inp, self.drp, arg)
@@ -569,7 +469,7 @@ class DL_Model:
             if self.cls['with_poi_ate']: self.add_ATENCO(inp, 'po_ir', self.drp, arg)
 
         if self.cls['with_fea']:
-            with h5py.File(self.pth, 'r') as dtb:
+            with open_fold(self.pth) as dtb:
                 inp = Input(shape=(dtb['fea_t'].shape[1], ))
                 self.add_LDENSE(inp, self.drp, arg)
 
@@ -621,7 +521,8 @@ class DL_Model:
     # patience is the parameter of the EarlyStopping callback
     # max_epochs refers to the amount of epochs achievable
     # batch refers to the batch_size
-    def learn(self, dropout=0.5, decrease=100, patience=3, max_epochs=100, batch=64):
+    # workers refers to the amount of threads preparing the batches
+    def learn(self, dropout=0.5, decrease=100, patience=3, max_epochs=100, batch=64, workers=1):
 
         # Compile the model
         decod, model = self.build(dropout, decrease)
@@ -637,10 +538,12 @@ class DL_Model:
         early = EarlyStopping(monitor=monitor, min_delta=1e-5, **arg)
         arg = {'save_best_only': True, 'save_weights_only': True}
         check = ModelCheckpoint(self.out, monitor=monitor, **arg)
-        if (len(self.l_e)/512) - int(len(self.l_e)/512) == 0 : steps = int(len(self.l_e)/512) -1
-        else : steps = int(len(self.l_e)/512)
-        kappa = Metrics(self.data_gen('e', self.mrg_size, batch=512), steps)
-        shuff = DataShuffler(self.pth, 3)
+        # Batches are prepared ahead by the workers of keras
+        # Training rows are shuffled by the sequence itself, through a permutation of indexes
+        t_seq = FoldSequence(self.pth, self.batch_keys('t'), self.l_t, self.n_c, 't', self.mrg_size, batch=batch, shuffle=True)
+        e_seq = FoldSequence(self.pth, self.batch_keys('e'), self.l_e, self.n_c, 'e', self.mrg_size, batch=batch)
+        m_seq = FoldSequence(self.pth, self.batch_keys('e'), self.l_e, self.n_c, 'e', self.mrg_size, batch=512, partial=True)
+        kappa = Metrics(m_seq, None)
 
         # Build and compile the model
         model = Model(inputs=self.inp, outputs=[model, decod])
@@ -650,12 +553,12 @@ class DL_Model:
         print('# Model Compiled')
         
         # Fit the model
-        his = model.fit_generator(self.data_gen('t', self.mrg_size, batch=batch),
-                    steps_per_epoch=len(self.l_t)//batch, verbose=1, 
-                    epochs=max_epochs, callbacks=[kappa, self.drp, early, check, shuff],
-                    shuffle=True, validation_steps=len(self.l_e)//batch,
-                    validation_data=self.data_gen('e', self.mrg_size, batch=batch), 
-                    class_weight=class_weight(self.l_t))
+        his = model.fit_generator(t_seq, steps_per_epoch=len(t_seq), verbose=1, 
+                    epochs=max_epochs, callbacks=[kappa, self.drp, early, check],
+                    shuffle=False, validation_steps=len(e_seq), validation_data=e_seq, 
+                    class_weight=class_weight(self.l_t), workers=workers, max_queue_size=10)
+
+        for seq in [t_seq, e_seq, m_seq]: seq.close()
 
         # Serialize its training history
         with open(self.his, 'wb') as raw: pickle.dump(his.history, raw)
@@ -726,77 +629,67 @@ class DL_Model:
         self.clf = model
         del model
 
+    # Size of the given set
+    # fmt refers to the set, whether training, testing or validation
+    def set_size(self, fmt):
+
+        if fmt == 't': return len(self.l_t)
+        if fmt == 'e': return len(self.l_e)
+        if fmt == 'v':
+            with open_fold(self.pth) as dtb: return dtb['eeg_1_v'].shape[0]
+
+    # Single pass over a set, filling preallocated outputs batch by batch
+    # fmt refers to the set, whether training, testing or validation
+    # probas refers whether to return the output probabilities
+    # features refers whether to return the feature map of the encoder
+    # batch refers to the batch size
+    def infer(self, fmt, probas=True, features=False, batch=512):
+
+        # Load the best model saved
+        if not hasattr(self, 'clf'): self.reconstruct()
+
+        # Heads shared by one forward pass, built once per model
+        out = []
+        if probas: out.append(self.clf.outputs[0])
+        if features: out.append(self.clf.get_layer('encode').output)
+        if not hasattr(self, 'heads'): self.heads = dict()
+        if (probas, features) not in self.heads: 
+            self.heads[(probas, features)] = Model(inputs=self.clf.input, outputs=out)
+        mod = self.heads[(probas, features)]
+
+        sze = self.set_size(fmt)
+        res = [np.empty((sze,) + K.int_shape(ele)[1:], dtype='float32') for ele in out]
+
+        rdr = BatchReader(self.pth, self.batch_keys(fmt), batch)
+
+        try:
+            for ind in range(0, sze, batch):
+                # Exact handling of the last incomplete batch
+                num = min(batch, sze - ind)
+                prd = mod.predict_on_batch(rdr.read(ind, num))
+                if len(res) == 1: prd = [prd]
+                for arr, val in zip(res, prd): arr[ind:ind+num] = val
+
+        finally: rdr.close()
+
+        return res
+
     # Validate on the unseen samples
     # fmt refers to whether apply it for testing or validation
     # batch refers to the batch size
     def predict(self, fmt, probas=False, batch=512):
 
-        # Load the best model saved
-        if not hasattr(self, 'clf'): self.reconstruct()
+        prd = self.infer(fmt, probas=True, batch=batch)[0]
 
-        # Defines the size of the validation set
-        if fmt == 'e': 
-            sze = len(self.l_e)
-        if fmt == 'v': 
-            with h5py.File(self.pth, 'r') as dtb: 
-                sze = dtb['eeg_1_v'].shape[0]
-
-        # Defines the tools for prediction
-        gen, ind, prd = self.data_val(fmt, batch=batch), 0, []
-
-        for vec in gen:
-            # Defines the right stop according to the batch_size
-            if (sze / batch) - int(sze / batch) == 0 : end = int(sze / batch)- 1
-            else : end = int(sze / batch)
-            # Iterate according to the right stopping point
-            if ind <= end :
-                if probas: prd += list(self.clf.predict(vec)[0])
-                else: prd += [np.argmax(pbs) for pbs in self.clf.predict(vec)[0]]
-                ind += 1
-            else : 
-                break
-
-        return np.asarray(prd)
+        if probas: return prd
+        else: return np.argmax(prd, axis=1)
 
     # Generates the feature map relative to the encoder build during training
-    # fmt refers to whether apply it for testing or validation
+    # fmt refers to whether apply it for training, testing or validation
     # batch refers to the batch size
     def get_feature_map(self, fmt, batch=512):
 
-        # Load the best model saved
-        if not hasattr(self, 'clf'): self.reconstruct()
-
-        # Defines the intermediary model
-        mod = Model(inputs=self.clf.input, outputs=self.clf.get_layer('encode').output)
-
-        # Defines the size of the validation set
-        if fmt == 't':
-            sze = len(self.l_t)
-            # Defines the tools for prediction
-            gen, ind, prd = self.data_gen(fmt, 10, batch=batch), 0, []
-        if fmt == 'e': 
-            sze = len(self.l_e)
-            # Defines the tools for prediction
-            gen, ind, prd = self.data_val(fmt, batch=batch), 0, []
-        if fmt == 'v':
-            with h5py.File(self.pth, 'r') as dtb: 
-                sze = dtb['eeg_1_v'].shape[0]
-            # Defines the tools for prediction
-            gen, ind, prd = self.data_val(fmt, batch=batch), 0, []
-
-        for vec in gen:
-            # Defines the right stop according to the batch_size
-            if (sze / batch) - int(sze / batch) == 0 : end = int(sze / batch)- 1
-            else : end = int(sze / batch)
-            # Iterate according to the right stopping point
-            if ind <= end :
-                if fmt == 't': prd.append(mod.predict(vec[0]))
-                else: prd.append(mod.predict(vec))
-                ind += 1
-            else : 
-                break
-
-        return np.vstack(tuple(prd))
+        return self.infer(fmt, probas=False, features=True, batch=batch)[0]
 
     # Generates the confusion matrixes for train, test and validation sets
     def confusion_matrix(self):
@@ -832,10 +725,12 @@ class DL_Model:
         del prd
 
     # Returns the test scores of the given model
-    def get_score(self):
+    # prd refers to already computed test probabilities, if any
+    def get_score(self, prd=None):
 
         # Compute the predictions for validation
-        prd = self.predict('e')
+        if prd is None: prd = self.predict('e')
+        else: prd = np.argmax(prd, axis=1)
         acc = accuracy_score(self.l_e, prd)
         f1s = f1_score(self.l_e, prd, average='weighted')
         kap = kappa_score(self.l_e, prd)
@@ -893,16 +788,15 @@ class CV_DL_Model:
             mod = DL_Model(path, self.cls, marker='ITER_{}'.format(idx))
             mod.learn(patience=10, dropout=0.6, decrease=150, batch=32, max_epochs=100)
             prd = mod.predict('v', probas=True)
-            tmp = np.asarray([np.argmax(ele) for ele in prd])
-            pbs.append(tmp)
+            pbs.append(np.argmax(prd, axis=1))
 
             # Serialize the output probabilities
             np.save('./models/PRD_MOD_V_{}.npy'.format(idx), prd)
             prd = mod.predict('e', probas=True)
             np.save('./models/PRD_MOD_E_{}.npy'.format(idx), prd)
 
-            # Save experiment characteristics
-            acc, f1s, kap = mod.get_score()
+            # Save experiment characteristics, from the same test probabilities
+            acc, f1s, kap = mod.get_score(prd=prd)
             
             # LOG file for those scores
             with open(log_file, 'a') as raw:
@@ -917,8 +811,7 @@ class CV_DL_Model:
         # Write output of cross-validation to a suitable file
         pbs = np.vstack(tuple(pbs)).T
         pbs = np_utils.to_categorical(pbs.ravel(), num_classes=5).reshape(pbs.shape[0], pbs.shape[1], 5)
-        pbs = np.sum(pbs, axis=1)
-        pbs = np.asarray([np.argmax(ele) for ele in pbs])
+        pbs = np.argmax(np.sum(pbs, axis=1), axis=1)
         idx = np.arange(43830, 64422)
         res = np.hstack((idx.reshape(-1,1), pbs.reshape(-1,1)))
 
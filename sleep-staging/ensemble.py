@@ -0,0 +1,128 @@
+# Dreem Headband Sleep Phases Classification Challenge
+# Ensemble inference over the fold models, free of any deep-learning package
+
+import glob, multiprocessing
+import h5py, joblib
+import numpy as np
+import xgboost as xgb
+
+from multiprocessing.pool import ThreadPool
+
+try: from package.registry import *
+except: from registry import *
+
+# Fitted booster served through the scikit-learn interface used by ML_Model
+
+class BoostedClassifier:
+
+    # Initialization
+    # booster refers to the native booster
+    # kind refers to the library, either 'LGB' or 'XGB'
+    # rounds refers to the amount of boosting rounds used for prediction
+    # classes refers to the labels of the classes
+    def __init__(self, booster, kind, rounds, classes):
+
+        self.booster = booster
+        self.kind = kind
+        self.rounds = rounds
+        self.classes_ = classes
+
+    def predict_proba(self, vec):
+
+        if self.kind == 'LGB': return self.booster.predict(vec, num_iteration=self.rounds)
+        if self.kind == 'XGB': return self.booster.predict(xgb.DMatrix(vec), ntree_limit=self.rounds)
+
+    def predict(self, vec):
+
+        return self.classes_[np.argmax(self.predict_proba(vec), axis=1)]
+
+# Defines the ensemble of fold models
+
+class Ensemble:
+
+    # Initialization, loading the models concurrently
+    # models refers to the serialization paths of the models
+    # threads refers to the amount of concurrent loads and evaluations
+    def __init__(self, models, threads=multiprocessing.cpu_count()):
+
+        self.pth = list(models)
+        self.threads = max(1, min(threads, len(self.pth)))
+
+        pol = ThreadPool(processes=self.threads)
+        try: self.mod = pol.map(REGISTRY.get, self.pth)
+        finally: pol.close()
+
+        # Columns of each model among all the classes
+        self.classes = np.unique(np.concatenate([mod.classes_ for mod in self.mod]))
+        self.col = [np.searchsorted(self.classes, mod.classes_) for mod in self.mod]
+
+    def __len__(self):
+
+        return len(self.mod)
+
+    # Evaluates a method of all the models concurrently, in the order of the models
+    # fun refers to the name of the method
+    # vec refers to the input matrix
+    def evaluate(self, fun, vec):
+
+        pol = ThreadPool(processes=self.threads)
+        try: return pol.map(lambda mod: getattr(mod, fun)(vec), self.mod)
+        finally: pol.close()
+
+    # Sums or averages the probabilities of the models
+    # vec refers to the input matrix
+    # average refers whether to divide by the amount of models
+    def probas(self, vec, average=False):
+
+        res = np.zeros((len(vec), len(self.classes)))
+        for col, prb in zip(self.col, self.evaluate('predict_proba', vec)): res[:,col] += prb
+
+        if average: res /= len(self.mod)
+
+        return res
+
+    # Counts the votes of the models for each class
+    # vec refers to the input matrix
+    def votes(self, vec):
+
+        res = np.zeros((len(vec), len(self.classes)), dtype=int)
+        row = np.arange(len(vec))
+        for prd in self.evaluate('predict', vec): np.add.at(res, (row, np.searchsorted(self.classes, prd)), 1)
+
+        return res
+
+    # Predicts the classes, by majority vote or through the summed probabilities
+    # vec refers to the input matrix
+    # soft refers whether to use the probabilities instead of the votes
+    def predict(self, vec, soft=False):
+
+        if soft: return self.classes[np.argmax(self.probas(vec), axis=1)]
+        else: return self.classes[np.argmax(self.votes(vec), axis=1)]
+
+# Features of the nights to score, as stored in the scaled files
+# pth refers to the HDF5 file holding the features
+# scaler refers to the serialized transformation to apply, if any
+def night_features(pth, scaler=None):
+
+    with h5py.File(pth, 'r') as dtb: vec = dtb['fea'][:,34:]
+    if scaler: vec = joblib.load(scaler).transform(vec)
+
+    return vec
+
+# Scores nights with the fold models of an estimator
+# Entry point of the scoring, importing neither the database chain nor any deep-learning package
+# nme refers to the name of the estimator
+# pth refers to the HDF5 file holding the features
+# scaler refers to the serialized transformation to apply, if any
+# models refers to the pattern of the serialized fold models
+# threads refers to the amount of concurrent loads and evaluations
+# proba refers whether to return the averaged probabilities instead of the voted classes
+def score_nights(nme, pth, scaler=None, models='./models/{}_*.pk', threads=multiprocessing.cpu_count(), proba=False):
+
+    # Pending dumps of the models have to end first
+    REGISTRY.flush()
+    ens = Ensemble(sorted(glob.glob(models.format(nme))), threads=threads)
+    vec = night_features(pth, scaler=scaler)
+
+    if proba: return ens.probas(vec, average=True)
+    else: return ens.predict(vec)
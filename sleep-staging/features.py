@@ -2,8 +2,8 @@
 # Nov 19th, 2018
 # Dreem Headband Sleep Phases Classification Challenge
 
-try: from package.toolbox import *
-except: from toolbox import *
+try: from package.decomposition import *
+except: from decomposition import *
 
 # Computes the pairwise distances between EEGs
 # signal refers to a 1D array
@@ -74,18 +74,6 @@ def frequency_features(signal, brain=False, sig_name=None):
     if sig_name: return res, nme
     else: return res
 
-# Parameters of the autoregressive models
-# vec refers to a 1D array
-
-def ar_coefficients(vec):
-
-    nan = np.where(np.invert(np.isnan(vec)))[0]
-
-    mod = AR(vec[nan])
-    mod = mod.fit()
-    
-    return list(mod.params)
-
 # Defines the amount of crossing-overs
 # val refers to a 1D array
 
@@ -103,22 +91,55 @@ def crossing_over(val):
 
 def entropy(val):
 
-    nan = np.where(np.invert(np.isnan(val)))[0]
-    vec = val[nan]
-    
-    dta = np.round(vec, 5)
-    cnt = Counter()
+    vec = np.round(val[np.invert(np.isnan(val))], 5)
+    if len(vec) == 0: return 0.0
+
+    _, cnt = np.unique(vec, return_counts=True)
+    pbs = cnt / len(vec)
 
-    for ele in dta: cnt[ele] += 1
+    return 0.0 - np.sum(pbs * np.log2(pbs))
 
-    pbs = [vec / len(dta) for vec in cnt.values()]
-    pbs = [prd for prd in pbs if prd > 0.0]
+# Batch version of entropy, counting the rounded values of each row at once
+# Matches entropy row by row, up to the order of the summation
+# mat refers to a 2D array
 
-    ent = 0.0
-    for prd in pbs:
-        ent -= prd * log(prd, 2.0)
+def entropy_batch(mat):
+
+    srt = np.sort(np.round(mat, 5), axis=1)
+    vld = np.invert(np.isnan(srt))
+
+    # Starts of the runs of equal values
+    beg = np.zeros(srt.shape, dtype=bool)
+    beg[:,0] = True
+    beg[:,1:] = srt[:,1:] != srt[:,:-1]
+    beg &= vld
+
+    # Size of each run, identified across the rows
+    idx = np.cumsum(beg, axis=1) - 1 + np.arange(len(srt))[:,None] * srt.shape[1]
+    cnt = np.bincount(idx[vld], minlength=srt.size).reshape(srt.shape).astype('float64')
+    tot = np.sum(vld, axis=1)
+
+    pbs = cnt / np.maximum(tot, 1)[:,None]
+    lgs = np.log2(np.where(cnt > 0, pbs, 1.0))
+
+    return 0.0 - np.sum(pbs * lgs, axis=1)
+
+# Describes the sections of constant sign
+# val refers to a 1D array
 
-    return ent
+def sign_sections(val):
+
+    sgn = np.sign(val)
+    sgn = np.split(sgn, np.where(np.diff(sgn) != 0)[0]+1)
+    sgn = np.asarray([len(ele) for ele in sgn])
+    res = [np.nanmean(sgn), np.std(sgn)]
+    
+    sgn, ine = np.asarray([0] + list(sgn)), 0.0
+    for idx in range(len(sgn)-1):
+        ine += (sgn[idx+1] - sgn[idx])*np.trapz(np.abs(val[np.sum(sgn[:idx]):np.sum(sgn[:idx+1])]))
+    res.append(ine)
+
+    return res
 
 # Defines the wavelet features
 # val refers to a 1D array
@@ -142,21 +163,12 @@ def wavelet_features(val, sig_name=None):
             nme.append('_'.join([sig_name, 'mean', key]))
             nme.append('_'.join([sig_name, 'std', key]))
 
-    sgn = np.sign(val)
-    sgn = np.split(sgn, np.where(np.diff(sgn) != 0)[0]+1)
-    sgn = np.asarray([len(ele) for ele in sgn])
-    res += [np.nanmean(sgn), np.std(sgn)]
+    res += sign_sections(val)
 
     if sig_name:
         nme.append('_'.join([sig_name, 'mean_sign']))
         nme.append('_'.join([sig_name, 'std_sign']))
-    
-    sgn, ine = np.asarray([0] + list(sgn)), 0.0
-    for idx in range(len(sgn)-1):
-        ine += (sgn[idx+1] - sgn[idx])*np.trapz(np.abs(val[np.sum(sgn[:idx]):np.sum(sgn[:idx+1])]))
-    res.append(ine)
-
-    if sig_name: nme.append('_'.join([sig_name, 'sections_area']))
+        nme.append('_'.join([sig_name, 'sections_area']))
 
     if sig_name: return res, nme
     else: return res
@@ -199,39 +211,42 @@ def neural_entropy_features(val, sig_name=None):
     if sig_name: return res, nme
     else: return res
 
-# Defines the feature construction pipeline
-# val refers to a 1D array
-
-def stats_features(val, sig_name=None):
+# Basic statistics of a signal, NaN excluded
+# signal refers to a 1D array
 
-    def nested_stats(signal, sig_name=None):
-        
-        res = []
+def nested_stats(signal, sig_name=None):
+    
+    res = []
 
-        nan = np.where(np.invert(np.isnan(signal)))[0]
-        
-        res.append(min(signal[nan]))
-        res.append(max(signal[nan]))
-        res.append(np.nanmean(signal[nan]))
-        res.append(np.nanstd(signal[nan]))
-        res.append(kurtosis(signal[nan]))
-        res.append(skew(signal[nan]))
-        res.append(entropy(signal[nan]))
+    nan = np.where(np.invert(np.isnan(signal)))[0]
+    
+    res.append(min(signal[nan]))
+    res.append(max(signal[nan]))
+    res.append(np.nanmean(signal[nan]))
+    res.append(np.nanstd(signal[nan]))
+    res.append(kurtosis(signal[nan]))
+    res.append(skew(signal[nan]))
+    res.append(entropy(signal[nan]))
 
-        if sig_name:
+    if sig_name:
 
-            nme = []
-            nme.append('_'.join([sig_name, 'min']))
-            nme.append('_'.join([sig_name, 'max']))
-            nme.append('_'.join([sig_name, 'mean']))
-            nme.append('_'.join([sig_name, 'std']))
-            nme.append('_'.join([sig_name, 'kurtosis']))
-            nme.append('_'.join([sig_name, 'skew']))
-            nme.append('_'.join([sig_name, 'entropy']))
-        
-        if sig_name: return res, nme
-        else: return res
+        nme = []
+        nme.append('_'.join([sig_name, 'min']))
+        nme.append('_'.join([sig_name, 'max']))
+        nme.append('_'.join([sig_name, 'mean']))
+        nme.append('_'.join([sig_name, 'std']))
+        nme.append('_'.join([sig_name, 'kurtosis']))
+        nme.append('_'.join([sig_name, 'skew']))
+        nme.append('_'.join([sig_name, 'entropy']))
     
+    if sig_name: return res, nme
+    else: return res
+
+# Defines the feature construction pipeline
+# val refers to a 1D array
+
+def stats_features(val, sig_name=None):
+
     # Build the feature vector
     if sig_name: res, nme = nested_stats(val, sig_name=sig_name)
     else: res = nested_stats(val)
@@ -242,27 +257,28 @@ def stats_features(val, sig_name=None):
 
     # Common features
 
-    dec = seasonal_decompose(val, model='additive', freq=int(len(val)/30))
+    trd, _, rsd = seasonal_decompose_batch(val[None,:], int(len(val)/30))
+    trd, rsd = trd[0], rsd[0]
     if sig_name: 
-        tmp, lbl = nested_stats(dec.trend, sig_name='_'.join([sig_name, 'trend']))
+        tmp, lbl = nested_stats(trd, sig_name='_'.join([sig_name, 'trend']))
         res += tmp
         nme += lbl
-    else: res += nested_stats(dec.trend)
+    else: res += nested_stats(trd)
     
     if sig_name: nme.append('_'.join([sig_name, 'cross_over']))
-    res.append(crossing_over(dec.trend))
+    res.append(crossing_over(trd))
 
     if sig_name:
-        tmp = ar_coefficients(dec.trend)
+        tmp = list(ar_coefficients_batch(trd[None,np.invert(np.isnan(trd))])[0])
         res += tmp
         nme += ['{}_AR_{}'.format(sig_name, i) for i in range(len(tmp))]
-    else: res += ar_coefficients(dec.trend)
+    else: res += list(ar_coefficients_batch(trd[None,np.invert(np.isnan(trd))])[0])
 
     if sig_name: 
-        tmp, lbl = nested_stats(dec.resid, sig_name='_'.join([sig_name, 'resid']))
+        tmp, lbl = nested_stats(rsd, sig_name='_'.join([sig_name, 'resid']))
         res += tmp
         nme += lbl
-    else: res += nested_stats(dec.resid)
+    else: res += nested_stats(rsd)
     
     if sig_name: return res, nme
     else: return res
@@ -297,6 +313,164 @@ def compute_features(val, brain=False, sig_name=None):
     if sig_name: return np.asarray(res), np.asarray(nme)
     else: return np.asarray(res)
 
+# Applies a 1D function on each row of a matrix
+# fun refers to a function returning a scalar or a list
+# mat refers to a 2D array
+
+def apply_rows(fun, mat):
+
+    return np.asarray([fun(row) for row in mat])
+
+# Removes the columns that are NaN for every row
+# Returns None when NaN are not shared between the rows
+# mat refers to a 2D array
+
+def drop_nan_columns(mat):
+
+    msk = np.isnan(mat)
+
+    if not msk.any(): return mat
+    elif (msk == msk[0]).all(): return mat[:,np.invert(msk[0])]
+    else: return None
+
+# Batch version of nested_stats
+# mat refers to a 2D array of epochs
+
+def nested_stats_batch(mat):
+
+    sub = drop_nan_columns(mat)
+    if sub is None: return apply_rows(nested_stats, mat)
+
+    res = []
+    res.append(np.min(sub, axis=1))
+    res.append(np.max(sub, axis=1))
+    res.append(np.nanmean(sub, axis=1))
+    res.append(np.nanstd(sub, axis=1))
+    res.append(kurtosis(sub, axis=1))
+    res.append(skew(sub, axis=1))
+    res.append(entropy_batch(sub))
+
+    return np.column_stack(res)
+
+# Batch version of crossing_over
+# mat refers to a 2D array of epochs
+
+def crossing_over_batch(mat):
+
+    sub = drop_nan_columns(mat)
+    if sub is None: return apply_rows(crossing_over, mat)
+
+    return np.count_nonzero(np.diff(np.sign(sub), axis=1), axis=1)
+
+# Batch version of stats_features
+# mat refers to a 2D array of epochs
+
+def stats_features_batch(mat):
+
+    res = [nested_stats_batch(mat)]
+    res.append(np.percentile(mat, [25, 50, 75], axis=1).T)
+
+    # Decomposition over the whole block
+    trd, _, rsd = seasonal_decompose_batch(mat, int(mat.shape[1]/30))
+
+    res.append(nested_stats_batch(trd))
+    res.append(crossing_over_batch(trd))
+    res.append(ar_coefficients_batch(drop_nan_columns(trd)))
+    res.append(nested_stats_batch(rsd))
+    del trd, rsd
+
+    return np.column_stack(res)
+
+# Batch version of frequency_features
+# mat refers to a 2D array of epochs
+
+def frequency_features_batch(mat, brain=False):
+
+    res, f_s = [], int(mat.shape[1]/30.0)
+
+    # Basic features
+    f,s = sg.periodogram(mat, fs=f_s, axis=1)
+    res.append(f[s.argmax(axis=1)])
+    res.append(np.max(s, axis=1))
+    res.append(np.sum(s, axis=1))
+    res.append(entropy_batch(s))
+
+    # Brain waves frequencies
+    if brain:
+
+        for low, upp in [(0.5, 3.0), (3.0, 8.0), (12., 38.), (38., 42.)]:
+            res.append(np.sum(s[:,np.where((f > low) & (f < upp))[0]], axis=1))
+
+        f,_,S = sg.spectrogram(mat, fs=f_s, return_onesided=True, axis=1)
+        res.append(f[S.argmax(axis=1)])
+        psd = np.sum(S, axis=1)
+        res.append(np.mean(psd, axis=1))
+        res.append(np.std(psd, axis=1))
+        res.append(entropy_batch(psd))
+        del S
+
+        f,_,Z = sg.stft(mat, fs=f_s, window='hamming', nperseg=int(5*f_s), noverlap=int(0.75*5*f_s), axis=1)
+        Z = np.abs(Z)
+        res.append(f[Z.argmax(axis=1)])
+        psd = np.sum(Z, axis=1)
+        res.append(np.mean(psd, axis=1))
+        res.append(np.std(psd, axis=1))
+        res.append(entropy_batch(psd))
+        del Z
+
+    return np.column_stack(res)
+
+# Batch version of wavelet_features
+# mat refers to a 2D array of epochs
+
+def wavelet_features_batch(mat):
+
+    res = []
+
+    cA_5, cD_5, cD_4, cD_3, _, _ = pywt.wavedec(mat, 'db4', level=5, axis=1)
+
+    for sig in [cA_5, cD_5, cD_4, cD_3]:
+        res += [np.min(sig, axis=1), np.max(sig, axis=1), np.sum(np.square(sig), axis=1)]
+        res += [np.mean(sig, axis=1), np.std(sig, axis=1)]
+
+    res.append(apply_rows(sign_sections, mat))
+
+    return np.column_stack(res)
+
+# Versions of the feature families
+# Increase a version whenever the corresponding computation changes
+
+FAMILIES = {'stats': 2, 'frequency': 1, 'neural': 1, 'wavelet': 1, 'distances': 1}
+
+# Ordered families building the features of a channel
+# brain refers whether the channel is an EEG
+
+def feature_families(brain=False):
+
+    if brain: return ['stats', 'frequency', 'neural', 'wavelet']
+    else: return ['stats', 'frequency']
+
+# Computation of a single family of features over a whole channel
+# mat refers to a 2D array of epochs, one per row
+# family refers to a key of FAMILIES
+
+def compute_family_batch(mat, family, brain=False):
+
+    if family == 'stats': return stats_features_batch(mat)
+    if family == 'frequency': return frequency_features_batch(mat, brain=brain)
+    if family == 'neural': return apply_rows(neural_entropy_features, mat)
+    if family == 'wavelet': return wavelet_features_batch(mat)
+    if family == 'distances': return compute_distances_batch(mat)
+
+# General computation of features over a whole channel
+# mat refers to a 2D array of epochs, one per row
+
+def compute_features_batch(mat, brain=False):
+
+    res = [compute_family_batch(mat, fam, brain=brain) for fam in feature_families(brain)]
+
+    return np.hstack(tuple(res))
+
 # Compute pairwise euclidean distance between eeg signals
 
 def compute_distances(idx, h5_path='./dataset/train.h5'):
@@ -306,6 +480,13 @@ def compute_distances(idx, h5_path='./dataset/train.h5'):
         
     return pairwise_distances(vec)[np.triu_indices(4, k=1)]
 
+# Batch version of compute_distances
+# mat refers to a 3D array of shape (epochs, 4, samples)
+
+def compute_distances_batch(mat):
+
+    return np.asarray([pairwise_distances(vec)[np.triu_indices(4, k=1)] for vec in mat])
+
 # Returns the list of feature labels
 
 def give_name_to_features():
@@ -7,6 +7,7 @@
 import h5py, multiprocessing, nolds, sys, six
 import pickle, warnings, time, pywt, joblib
 import neurokit, os, shlex, subprocess, GPUtil, glob
+import tempfile, shutil, hashlib, json, threading, queue
 
 import numpy as np
 import pandas as pd
@@ -18,12 +19,11 @@ from hyperopt import hp
 from hyperopt.pyll.stochastic import sample
 
 from functools import partial
-from collections import Counter
+from multiprocessing.pool import ThreadPool
+from collections import Counter, OrderedDict
 from scipy.stats import kurtosis, skew
 from scipy.interpolate import interp1d
 from arch.bootstrap import CircularBlockBootstrap
-from statsmodels.tsa.ar_model import AR
-from statsmodels.tsa.seasonal import seasonal_decompose
 
 from sklearn.svm import SVC, LinearSVC
 from sklearn.utils import shuffle
@@ -47,26 +47,30 @@ from imblearn.over_sampling import RandomOverSampler
 import xgboost as xgb
 import lightgbm as lgb
 
-import tensorflow as tf
-
-from keras import backend as K
-from keras import regularizers, initializers
-from keras.utils import np_utils
-from keras.models import Model, load_model, Sequential
-from keras.layers import Convolution2D, MaxPooling2D, Flatten
-from keras.layers import Conv1D, Input, MaxPooling1D, GlobalAveragePooling1D
-from keras.layers import AveragePooling1D, AveragePooling2D, UpSampling1D
-from keras.layers import BatchNormalization, GlobalAveragePooling2D, Add
-from keras.layers import GlobalMaxPooling1D, MaxoutDense, PReLU, LSTM
-from keras.layers import Bidirectional, GaussianNoise, Subtract, Lambda
-from keras.layers.core import Dense, Dropout, Activation, Reshape
-from keras.callbacks import EarlyStopping, ModelCheckpoint, Callback
-from keras.objectives import mse
-from keras.optimizers import Adadelta, Adam
-from keras.constraints import max_norm
-from keras.layers.merge import concatenate
-from keras.engine.topology import Layer
-from keras.utils.training_utils import multi_gpu_model
+# Deep-learning packages, skipped by the lightweight workers
+
+if not os.environ.get('LIGHT_IMPORTS'):
+
+    import tensorflow as tf
+
+    from keras import backend as K
+    from keras import regularizers, initializers
+    from keras.utils import np_utils, Sequence
+    from keras.models import Model, load_model, Sequential
+    from keras.layers import Convolution2D, MaxPooling2D, Flatten
+    from keras.layers import Conv1D, Input, MaxPooling1D, GlobalAveragePooling1D
+    from keras.layers import AveragePooling1D, AveragePooling2D, UpSampling1D
+    from keras.layers import BatchNormalization, GlobalAveragePooling2D, Add
+    from keras.layers import GlobalMaxPooling1D, MaxoutDense, PReLU, LSTM
+    from keras.layers import Bidirectional, GaussianNoise, Subtract, Lambda
+    from keras.layers.core import Dense, Dropout, Activation, Reshape
+    from keras.callbacks import EarlyStopping, ModelCheckpoint, Callback
+    from keras.objectives import mse
+    from keras.optimizers import Adadelta, Adam
+    from keras.constraints import max_norm
+    from keras.layers.merge import concatenate
+    from keras.engine.topology import Layer
+    from keras.utils.training_utils import multi_gpu_model
 
 # Graphical imports
 
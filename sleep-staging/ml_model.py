@@ -3,8 +3,104 @@
 # Dreem Headband Sleep Phases Classification Challenge
 
 from package.database import *
+from package.registry import *
+from package.boosting import *
+from package.ensemble import *
 from hyperband.optimizer import *
 
+# Data of the folds, shared with the workers through their initializer
+FOLDS = None
+
+# Makes the data of the folds available to fold_model
+# vec refers to the features
+# lab refers to the labels
+# ext refers to an additional matrix to get the probabilities of, if any
+def share_folds(vec, lab, ext=None):
+
+    global FOLDS
+    FOLDS = (vec, lab, ext)
+
+# Initialization of the fold workers, inheriting the data on fork
+def init_folds(vec, lab, ext=None):
+
+    init_worker()
+    share_folds(vec, lab, ext)
+
+# Tunes, scores and predicts the model of one fold
+# arg refers to (nme, mkr, i_t, i_e, max_iter, threads, mp, warm, spill)
+def fold_model(arg):
+
+    nme, mkr, i_t, i_e, max_iter, threads, mp, warm, spill = arg
+    vec, lab, ext = FOLDS
+
+    # Build the corresponding tuned model
+    mod = ML_Model(threads=threads, mp=mp, spill=spill)
+    mod.l_t = lab[i_t]
+    mod.l_e = lab[i_e]
+    mod.train = vec[i_t]
+    mod.valid = vec[i_e]
+    # Launch the hyperband optimization
+    mod.learn(nme, marker=mkr, max_iter=max_iter, warm=warm)
+    # Retrieve the scores and the probabilities
+    a,k = mod.score(nme, marker=mkr)
+    prb = mod.proba(nme, marker=mkr)
+    if ext is None: prx = None
+    else: prx = mod.clf.predict_proba(ext)
+
+    # The worker exits after the fold, once its model is persisted
+    REGISTRY.flush()
+    REGISTRY.clear()
+    del mod
+
+    return a, k, prb, prx
+
+# Splits the threads between the concurrent folds and their estimators
+# threads refers to the amount of affordable threads
+# n_folds refers to the amount of folds
+# workers refers to the amount of concurrent folds, all of them by default
+def fold_threads(threads, n_folds, workers=None):
+
+    if workers is None: workers = n_folds
+    workers = max(1, min(workers, n_folds, threads))
+
+    return workers, max(1, threads // workers)
+
+# Runs the folds on a process pool, yielding their results in the order of the folds
+# nme refers to the type of model to use
+# prefix refers to the marker of the fold models
+# vec refers to the features
+# lab refers to the labels
+# splits refers to the list of (i_t, i_e) indexes
+# max_iter refers to the amount of iterations with the hyperband algorithm
+# threads refers to the amount of affordable threads
+# mp refers to whether hyperband uses multiprocessing, only when the folds are sequential
+# workers refers to the amount of concurrent folds
+# ext refers to an additional matrix to get the probabilities of, if any
+# warm refers whether boosting models are tuned over their rounds, see ML_Model.learn
+# spill refers to the directory of the out-of-core files, see ML_Model
+def run_folds(nme, prefix, vec, lab, splits, max_iter, threads, mp=False, workers=None, ext=None, warm=False, spill=None):
+
+    workers, n_jobs = fold_threads(threads, len(splits), workers)
+    arg = [(nme, '{}_{}'.format(prefix, idx), i_t, i_e, max_iter, n_jobs, mp and workers == 1, warm, spill) 
+           for idx, (i_t, i_e) in enumerate(splits)]
+
+    if workers == 1:
+        share_folds(vec, lab, ext)
+        try:
+            for ele in arg: yield fold_model(ele)
+        finally: share_folds(None, None)
+
+    else:
+        # Daemonic workers can not start the pool of hyperband, hence mp is disabled
+        pol = multiprocessing.Pool(processes=workers, initializer=init_folds, initargs=(vec, lab, ext), maxtasksperchild=1)
+        try:
+            for res in pol.imap(fold_model, arg): yield res
+            pol.close()
+        except:
+            pol.terminate()
+            raise
+        finally: pol.join()
+
 # Defines a structure for the machine-learning models
 
 class ML_Model:
@@ -12,31 +108,43 @@ class ML_Model:
     # Initialization
     # path refers to the absolute path towards the datasets
     # threads refers to the amount of affordable threads
-    def __init__(self, path=None, threads=multiprocessing.cpu_count(), mp=False):
+    # memory refers whether to load the features, otherwise read by blocks of chunk rows
+    # spill refers to the directory of the out-of-core files, next to the features by default
+    def __init__(self, path=None, threads=multiprocessing.cpu_count(), mp=False, memory=True, chunk=4096, spill=None):
 
         # Attributes
         self.njobs = threads
         self.mp = mp
+        self.memory = memory
+        self.chunk = chunk
+        self.spill = spill
 
         if path:
             # Needed attribute
             self.input = path
             # Apply on the data
-            with h5py.File(self.input, 'r') as dtb:
+            with open_fold(self.input) as dtb:
                 # Load the labels and initialize training and testing sets
                 self.l_t = dtb['lab_t'].value.ravel()
                 self.l_e = dtb['lab_e'].value.ravel()
                 # Define the specific anomaly issue
                 self.n_c = len(np.unique(list(self.l_t) + list(self.l_e)))
                 # Defines the vectors
-                self.train = dtb['fea_t'].value
-                self.valid = dtb['fea_e'].value
+                if memory:
+                    self.train = dtb['fea_t'].value
+                    self.valid = dtb['fea_e'].value
+
+            # Out-of-core features, left on disk
+            if not memory:
+                self.train = FeatureBlocks(self.input, 'fea_t', chunk=chunk)
+                self.valid = FeatureBlocks(self.input, 'fea_e', chunk=chunk)
 
     # Application of the ML models
     # nme refers to the type of model to use
     # marker refers to the identity of the model
     # max_iter refers to the amount of iterations with the hyperband algorithm
-    def learn(self, nme, marker=None, max_iter=100):
+    # warm refers whether LGB and XGB are tuned over their boosting rounds, without refitting
+    def learn(self, nme, marker=None, max_iter=100, warm=False):
 
         # Defines the data representation folder
         val = dict()
@@ -46,6 +154,33 @@ class ML_Model:
         val['x_valid'] = self.valid
         val['y_valid'] = self.l_e
         val['w_valid'] = sample_weight(self.l_e)
+
+        # Out-of-core features are only handled by the boosting libraries
+        ooc = isinstance(self.train, FeatureBlocks)
+        if ooc and nme not in ['LGB', 'XGB']:
+            raise ValueError('Out-of-core training only handles LGB and XGB, not {}'.format(nme))
+
+        # Surviving configurations are continued, the best iteration is kept as is
+        if (warm and nme in ['LGB', 'XGB']) or ooc:
+            # Files as large as the features, kept off the usually memory-backed temporary directory
+            if ooc: tmp = tempfile.mkdtemp(dir=self.spill or os.path.dirname(os.path.abspath(self.train.pth)))
+            else: tmp = None
+            try:
+                if ooc:
+                    # Spilled once, then read by the libraries without the whole matrix in memory
+                    cls = np.unique(self.l_t)
+                    arg = (self.train, np.searchsorted(cls, self.l_t), os.path.join(tmp, 'train.svm'))
+                    val['x_train'] = spill_libsvm(*arg)
+                    arg = (self.valid, np.searchsorted(cls, self.l_e), os.path.join(tmp, 'valid.svm'))
+                    val['x_valid'] = spill_libsvm(*arg)
+                hyp = BoostingHyperband(nme, get_params, max_iter=max_iter, n_jobs=self.njobs)
+                hyp.run(val, skip_brackets=1)
+                self.clf = hyp.model()
+            finally:
+                if tmp is not None: shutil.rmtree(tmp, ignore_errors=True)
+            REGISTRY.put(self.path(nme, marker), self.clf)
+            return
+
         # Defines the random search through cross-validation
         hyp = Hyperband(get_params, try_params, max_iter=max_iter, n_jobs=self.njobs, mp=self.mp)
         res = hyp.run(nme, val, skip_last=1)
@@ -71,10 +206,37 @@ class ML_Model:
             mod = SVC(**params)
         # Refit the best model
         mod.fit(val['x_train'], val['y_train'], sample_weight=val['w_train'])
-        # Serialize the best obtained model
+        # Keep the best obtained model, serialized in the background
+        self.clf = mod
+        REGISTRY.put(self.path(nme, marker), mod)
+
+    # Serialization path of a model
+    # nme refers to the type of model
+    # marker refers to the identity of the model
+    def path(self, nme, marker=None):
+
         if marker is None: self.mod = './models/{}.pk'.format(nme)
         else: self.mod = './models/{}_{}.pk'.format(nme, marker)
-        joblib.dump(mod, self.mod)
+
+        return self.mod
+
+    # Applies a method of a model to features, block by block when they are left on disk
+    # clf refers to the fitted model
+    # fun refers to the name of the method
+    # vec refers to the features
+    def evaluate(self, clf, fun, vec):
+
+        if isinstance(vec, FeatureBlocks): return np.concatenate([getattr(clf, fun)(mat) for mat in vec.blocks()])
+        else: return getattr(clf, fun)(vec)
+
+    # Serves the fitted model, from memory when possible
+    # nme refers to the type of model
+    # marker refers to the identity of the model
+    def model(self, nme, marker=None):
+
+        self.clf = REGISTRY.get(self.path(nme, marker))
+
+        return self.clf
 
     # Defines the confusion matrix on train, test and validation sets
     # nme refers to a new path if necessary
@@ -85,12 +247,10 @@ class ML_Model:
         warnings.simplefilter('ignore')
 
         # Load the model if necessary
-        if marker is None: self.mod = './models/{}.pk'.format(nme)
-        else: self.mod = './models/{}_{}.pk'.format(nme, marker)
-        clf = joblib.load(self.mod)
+        clf = self.model(nme, marker)
 
         # Compute the predictions for validation
-        prd = clf.predict(self.valid)
+        prd = self.evaluate(clf, 'predict', self.valid)
 
         return accuracy_score(self.l_e, prd), kappa_score(self.l_e, prd)
 
@@ -103,9 +263,7 @@ class ML_Model:
         warnings.simplefilter('ignore')
 
         # Load the model if necessary
-        if marker is None: self.mod = './models/{}.pk'.format(nme)
-        else: self.mod = './models/{}_{}.pk'.format(nme, marker)
-        clf = joblib.load(self.mod)
+        clf = self.model(nme, marker)
 
         # Method to build and display the confusion matrix
         def build_matrix(prd, true, title):
@@ -130,7 +288,7 @@ class ML_Model:
             plt.show()
 
         # Compute the predictions for validation
-        prd = clf.predict(self.valid)
+        prd = self.evaluate(clf, 'predict', self.valid)
         build_matrix(prd, self.l_e, 'TEST')
         del prd
 
@@ -143,12 +301,10 @@ class ML_Model:
         warnings.simplefilter('ignore')
 
         # Load the model if necessary
-        if marker is None: self.mod = './models/{}.pk'.format(nme)
-        else: self.mod = './models/{}_{}.pk'.format(nme, marker)
-        clf = joblib.load(self.mod)
+        clf = self.model(nme, marker)
 
         # Compute the predictions for validation
-        prb = clf.predict_proba(self.valid)
+        prb = self.evaluate(clf, 'predict_proba', self.valid)
 
         return prb
 
@@ -162,13 +318,13 @@ class ML_Model:
         warnings.simplefilter('ignore')
 
         # Load the model if necessary
-        if marker is None: self.mod = './models/{}.pk'.format(nme)
-        else: self.mod = './models/{}_{}.pk'.format(nme, marker)
-        clf = joblib.load(self.mod)
+        clf = self.model(nme, marker)
 
-        with h5py.File(self.input, 'r') as dtb: self.evals = dtb['fea_v'].value
+        if self.memory:
+            with open_fold(self.input) as dtb: self.evals = dtb['fea_v'].value
+        else: self.evals = FeatureBlocks(self.input, 'fea_v', chunk=self.chunk)
         # Compute the predictions for validation
-        prd = clf.predict(self.evals)
+        prd = self.evaluate(clf, 'predict', self.evals)
         idx = np.arange(43830, 64422)
         res = np.hstack((idx.reshape(-1,1), prd.reshape(-1,1)))
 
@@ -179,6 +335,9 @@ class ML_Model:
         if out is None: out = './results/test_{}.csv'.format(int(time.time()))
         res.to_csv(out, index=False, header=True, sep=';')
 
+        # Surfaces any failed serialization of the model
+        REGISTRY.flush()
+
 # Defines a structure for a cross_validation
 
 class CV_ML_Model:
@@ -187,12 +346,17 @@ class CV_ML_Model:
     # path refers to the absolute path towards the datasets
     # k_fold refers to 
     # threads refers to the amount of affordable threads
-    def __init__(self, path, k_fold=7, mp=False, threads=multiprocessing.cpu_count()):
+    # workers refers to the amount of folds run concurrently, all of them by default
+    # memory refers whether to load the features, otherwise read by blocks of chunk rows
+    # spill refers to the directory of the out-of-core files, next to the features by default
+    def __init__(self, path, k_fold=7, mp=False, threads=multiprocessing.cpu_count(), workers=None, memory=True, chunk=4096, spill=None):
 
         # Attributes
         self.input = path
         self.njobs = threads
         self.mp = mp
+        self.workers = workers
+        self.spill = spill
 
         # Apply on the data
         with h5py.File(self.input, 'r') as dtb:
@@ -201,48 +365,47 @@ class CV_ML_Model:
             # Define the specific anomaly issue
             self.n_c = len(np.unique(self.lab))
             # Defines the vectors
-            self.vec = dtb['fea'].value[:,34:]
+            if memory: self.vec = dtb['fea'].value[:,34:]
 
         # Defines the cross-validation splits
         self.kfs = StratifiedKFold(n_splits=k_fold, shuffle=True)
 
         # Apply feature filtering based on variance
-        vtf = VarianceThreshold(threshold=0.0)
-        self.vec = vtf.fit_transform(self.vec)
+        if memory:
+            vtf = VarianceThreshold(threshold=0.0)
+            self.vec = vtf.fit_transform(self.vec)
+        # Variances are streamed, the selection is applied to each block read
+        else:
+            self.vec = FeatureBlocks(self.input, 'fea', cols=slice(34, None), chunk=chunk)
+            vtf = variance_threshold(self.vec, threshold=0.0)
+            self.vec = self.vec.select(vtf.get_support())
         joblib.dump(vtf, './models/VTF_Selection.jb')
 
     # CV Launcher
     # nme refers to the type of model to be launched
     # max_iter refers to the amount of iterations with the hyperband algorithm
     # log_file refers to where to store the intermediate scores
-    def launch(self, nme, max_iter=100, log_file='./models/CV_SCORING.log'):
+    # warm refers whether boosting models are tuned over their rounds, see ML_Model.learn
+    def launch(self, nme, max_iter=100, log_file='./models/CV_SCORING.log', warm=False):
 
         out = np.zeros((len(self.lab), self.n_c))
+        spl = list(self.kfs.split(self.lab, self.lab))
+
+        # Folds are tuned concurrently, their results come back in order
+        arg = {'threads': self.njobs, 'mp': self.mp, 'workers': self.workers, 'warm': warm, 'spill': self.spill}
+        for idx, (a, k, prb, _) in enumerate(run_folds(nme, 'CV', self.vec, self.lab, spl, max_iter, **arg)):
 
-        for idx, (i_t, i_e) in enumerate(self.kfs.split(self.lab, self.lab)):
-
-            # Build the corresponding tuned model
-            mkr = 'CV_{}'.format(idx)
-            mod = ML_Model(threads=self.njobs, mp=self.mp)
-            mod.l_t = self.lab[i_t]
-            mod.l_e = self.lab[i_e]
-            mod.train = self.vec[i_t]
-            mod.valid = self.vec[i_e]
-            # Launch the hyperband optimization
-            mod.learn(nme, marker=mkr, max_iter=max_iter)
-            # Retrieve the scores
-            a,k = mod.score(nme, marker=mkr)
             # Add the probabilities to the main launcher
-            out[i_e,:] = mod.proba(nme, marker=mkr)
+            out[spl[idx][1],:] = prb
             # LOG file for those scores
             with open(log_file, 'a') as raw:
                 raw.write('# CV_ROUND {} | Accuracy {:3f} | Kappa {:3f} \n'.format(idx, a, k))
 
             # Memory efficiency
-            del mkr, mod, a, k
+            del a, k, prb
 
         # Write the general score
-        prd = [np.argmax(ele) for ele in out]
+        prd = np.argmax(out, axis=1)
         acc = accuracy_score(self.lab, prd)
         kap = kappa_score(self.lab, prd)
         # LOG file for those scores
@@ -260,28 +423,8 @@ class CV_ML_Model:
     # scaler refers whether feature extraction has been used
     def make_predictions(self, valid, nme, scaler=None):
 
-        # Apply on the data
-        with h5py.File(valid, 'r') as dtb:
-            if scaler:
-                # Load the scaler
-                vtf = joblib.load(scaler)
-                # Defines the vectors
-                vec = vtf.transform(dtb['fea'].value[:,34:])
-            else:
-                vec = dtb['fea'].value[:,34:]
-
-        # Initial vector for result storing
-        res = np.zeros((len(vec), self.n_c))
-
-        # Look for all available models
-        lst = sorted(glob.glob('./models/{}_*.pk'.format(nme)))
-        for mod in lst:
-            # Load the model and make the predictions
-            mod = joblib.load(mod)
-            res += np_utils.to_categorical(mod.predict(vec), num_classes=self.n_c)
-
-        # Write to file
-        res = np.asarray([np.argmax(ele) for ele in res])
+        # Majority vote of all the available models
+        res = score_nights(nme, valid, scaler=scaler, threads=self.njobs)
         idx = np.arange(43830, 64422)
         res = np.hstack((idx.reshape(-1,1), res.reshape(-1,1)))
 
@@ -297,19 +440,11 @@ class CV_ML_Model:
     # storage refers to where to serialize the output array
     def serialize_probas(self, nme, storage='./models'):
 
-        vtf = joblib.load('./models/VTF_Selection.jb')
-
-        with h5py.File('./dataset/sca_valid.h5', 'r') as dtb:
-            prd = np.zeros((dtb['eeg_1'].shape[0], 5))
-            fea = vtf.transform(dtb['fea'].value[:,34:])
-
-        for idx, ele in enumerate(sorted(glob.glob('./models/{}_CV_*.pk'.format(nme)))):
-            prd += joblib.load(ele).predict_proba(fea)
-
-        prd /= len(glob.glob('./models/{}_CV_*.pk'.format(nme)))
+        arg = {'scaler': './models/VTF_Selection.jb', 'models': './models/{}_CV_*.pk', 'threads': self.njobs}
+        prd = score_nights(nme, './dataset/sca_valid.h5', proba=True, **arg)
 
         np.save('{}/PRD_{}.npy'.format(storage, nme), prd)
 
         # Memory efficiency
-        del vtf, prd, fea
+        del prd
 
@@ -16,12 +16,14 @@ class ML_Stacker:
     # mp is used by hyperband for multi-armed bandit
     # feature_map refers to the autoencoder reduction
     # threads refers to the amount of concurrent threads
-    def __init__(self, models, cv_folds=5, mp=False, feature_map=False, threads=multiprocessing.cpu_count()):
+    # workers refers to the amount of folds run concurrently, all of them by default
+    def __init__(self, models, cv_folds=5, mp=False, feature_map=False, threads=multiprocessing.cpu_count(), workers=None):
 
         self.pbs, self.prd = [], []
         self.kfs = StratifiedKFold(n_splits=cv_folds, shuffle=True)
         self.threads = threads
         self.mp = mp
+        self.workers = workers
 
         self.lab = pd.read_csv('./dataset/label.csv', sep=';', index_col=0).values.ravel()
         self.n_c = len(np.unique(self.lab))
@@ -48,35 +50,27 @@ class ML_Stacker:
     # nme defines the type of estimator to use
     # max_iter put a threshold on the amount of hyperband iterations
     # log_file refers to where to write the scoring outputs
-    def run(self, nme, max_iter=100, log_file='./models/CV_STACKING.log'):
+    # warm refers whether boosting models are tuned over their rounds, see ML_Model.learn
+    def run(self, nme, max_iter=100, log_file='./models/CV_STACKING.log', warm=False):
 
         # Avoid unnecessary logs
         warnings.simplefilter('ignore')
 
-        for idx, (i_t, i_e) in enumerate(self.kfs.split(self.lab, self.lab)):
+        spl = list(self.kfs.split(self.lab, self.lab))
 
-            # Build the corresponding tuned model
-            mkr = 'SK_{}'.format(idx)
-            mod = ML_Model(threads=self.threads, mp=self.mp)
-            mod.l_t = self.lab[i_t]
-            mod.l_e = self.lab[i_e]
-            mod.train = self.pbs[i_t]
-            mod.valid = self.pbs[i_e]
-            # Launch the hyperband optimization
-            mod.learn(nme, marker=mkr, max_iter=max_iter)
-            # Retrieve the scores
-            a,k = mod.score(nme, marker=mkr)
+        # Folds are tuned concurrently, their results come back in order
+        arg = {'threads': self.threads, 'mp': self.mp, 'workers': self.workers, 'ext': self.prd, 'warm': warm}
+        for idx, (a, k, _, prx) in enumerate(run_folds(nme, 'SK', self.pbs, self.lab, spl, max_iter, **arg)):
 
             # Add the probabilities to the main launcher
-            clf = joblib.load('./models/{}_{}.pk'.format(nme, mkr))
-            self.out += clf.predict_proba(self.prd)
+            self.out += prx
 
             # LOG file for those scores
             with open(log_file, 'a') as raw:
                 raw.write('# CV_ROUND {} | Accuracy {:3f} | Kappa {:3f} \n'.format(idx, a, k))
 
             # Memory efficiency
-            del mkr, mod, a, k
+            del a, k, prx
 
     # Write validation to file
     # out refers to the output path
@@ -0,0 +1,111 @@
+# Dreem Headband Sleep Phases Classification Challenge
+# In-memory registry of the fitted estimators, persisted in the background
+
+# Only standard packages, the registry being used for scoring without the whole chain
+import os, threading, joblib, atexit
+
+from collections import OrderedDict
+
+# Least-recently-used registry of models, keyed by their serialization path
+# Each model keeps the modification time and size of its file, rewritten files being reloaded
+
+class ModelRegistry:
+
+    # Initialization
+    # size refers to the maximal amount of models kept in memory
+    def __init__(self, size=8):
+
+        self.size = size
+        self.mod = OrderedDict()
+        self.lock = threading.Lock()
+        # Background dumps and their failures
+        self.thr = dict()
+        self.err = []
+
+    # Modification time and size of a serialized model, None when missing
+    # pth refers to the serialization path of the model
+    def stamp(self, pth):
+
+        try: sta = os.stat(pth)
+        except OSError: return None
+
+        return (sta.st_mtime_ns, sta.st_size)
+
+    # Keeps a model in memory, evicting the least recently used ones
+    # pth refers to the serialization path of the model
+    # mod refers to the fitted estimator
+    # persist refers whether to dump the model in the background
+    # stp refers to the stamp of the file the model was loaded from
+    def put(self, pth, mod, persist=True, stp=None):
+
+        with self.lock:
+            self.mod[pth] = (mod, stp)
+            self.mod.move_to_end(pth)
+            while len(self.mod) > self.size: self.mod.popitem(last=False)
+
+        if persist:
+            # A previous dump to the same path has to end first
+            self.wait(pth)
+            thr = threading.Thread(target=self.dump, args=(pth, mod))
+            with self.lock: self.thr[pth] = thr
+            thr.start()
+
+    # Worker side of the background persistence
+    # pth refers to the serialization path of the model
+    # mod refers to the fitted estimator
+    def dump(self, pth, mod):
+
+        try: joblib.dump(mod, pth)
+        except Exception as err:
+            with self.lock: self.err.append((pth, err))
+            return
+
+        # The model now matches its file, unless replaced meanwhile
+        stp = self.stamp(pth)
+        with self.lock:
+            if pth in self.mod and self.mod[pth][0] is mod: self.mod[pth] = (mod, stp)
+
+    # Serves a model from memory, loading it from disk otherwise
+    # Files rewritten since, by another process for instance, are loaded again
+    # pth refers to the serialization path of the model
+    def get(self, pth):
+
+        self.wait(pth)
+        stp = self.stamp(pth)
+
+        with self.lock:
+            if pth in self.mod and stp in (None, self.mod[pth][1]):
+                self.mod.move_to_end(pth)
+                return self.mod[pth][0]
+
+        mod = joblib.load(pth)
+        self.put(pth, mod, persist=False, stp=stp)
+
+        return mod
+
+    # Waits for the background dump of a model
+    # pth refers to the serialization path of the model
+    def wait(self, pth):
+
+        with self.lock: thr = self.thr.pop(pth, None)
+        if thr is not None: thr.join()
+
+    # Waits for all the background dumps, raising their failures
+    def flush(self):
+
+        with self.lock: lst = list(self.thr.keys())
+        for pth in lst: self.wait(pth)
+
+        with self.lock: err, self.err = self.err, []
+        if len(err) > 0: raise IOError('Could not persist {}: {}'.format(err[0][0], err[0][1]))
+
+    # Drops the models held in memory
+    def clear(self):
+
+        self.flush()
+        with self.lock: self.mod.clear()
+
+# Registry shared by the models of a process
+# Failed dumps are raised at exit at the latest, once the pending ones are over
+REGISTRY = ModelRegistry()
+atexit.register(REGISTRY.flush)
@@ -5,6 +5,135 @@
 try: from package.topology import *
 except: from topology import *
 
+# Initialization of the workers of a long-lived pool
+def init_worker():
+
+    warnings.simplefilter('ignore')
+
+# Worker side of the memory-mapped transport
+# arg refers to (fun, batch, inp, out, beg, end), where inp and out are (path, dtype, shape)
+def map_block(arg):
+
+    fun, batch, inp, out, beg, end = arg
+
+    val = np.memmap(inp[0], dtype=inp[1], mode='r', shape=inp[2])
+    res = np.memmap(out[0], dtype=out[1], mode='r+', shape=out[2])
+
+    if batch: res[beg:end] = fun(val[beg:end])
+    else:
+        for idx in range(beg, end): res[idx] = fun(val[idx])
+
+    res.flush()
+    del val, res
+
+# Worker side of the persistence computation, diagrams are sent back flattened
+# arg refers to (inp, beg, end), where inp is (path, dtype, shape)
+def diagram_block(arg):
+
+    inp, beg, end = arg
+
+    val = np.memmap(inp[0], dtype=inp[1], mode='r', shape=inp[2])
+    dgs = sublevel_persistence_batch(val[beg:end])
+    del val
+
+    res = []
+    for idx in range(2):
+        lst = [ele[idx] for ele in dgs]
+        res.append((np.asarray([len(ele) for ele in lst], dtype='int64'), np.vstack(lst + [np.zeros((0,2))])))
+
+    return res
+
+# Worker side of the persistence limits, as partial extrema of stored diagrams
+# arg refers to (pth, key, beg, end), the epochs to consider
+def diagram_extrema(arg):
+
+    pth, key, beg, end = arg
+    res = []
+
+    with h5py.File(pth, 'r') as dtb:
+        for drc in ['up', 'dw']:
+            off = dtb[key]['off_{}'.format(drc)]
+            fst, lst = int(off[beg]), int(off[end])
+            if fst == lst: res += [np.inf, -np.inf]
+            else: res += [np.min(dtb[key]['brt_{}'.format(drc)][fst:lst]), np.max(dtb[key]['dth_{}'.format(drc)][fst:lst])]
+
+    return res
+
+# Worker side of the derivations out of stored diagrams
+# arg refers to (fun, pth, key, out, ori, beg, end), where out is (path, dtype, shape)
+# and ori is the epoch stored in the first row of out
+def map_diagrams(arg):
+
+    fun, pth, key, out, ori, beg, end = arg
+
+    res = np.memmap(out[0], dtype=out[1], mode='r+', shape=out[2])
+    res[beg-ori:end-ori] = fun(read_diagrams(pth, key, beg, end))
+
+    res.flush()
+    del res
+
+# Chunked layout of the derived datasets, aligned on the batches of rows read by the models
+# shape refers to the shape of the dataset
+# dtype refers to the type of its values
+# batch refers to the amount of rows read at once
+# compression refers to the filter to apply, None for raw storage readable outside of h5py
+def h5_layout(shape, dtype='float64', batch=64, compression=None):
+
+    # Empty datasets are kept contiguous, chunks and filters needing at least one element
+    if 0 in tuple(shape): return dict()
+
+    byt = int(np.prod(shape[1:])) * np.dtype(dtype).itemsize
+    row = batch
+    # Keeps the chunks around one megabyte, as divisors of the batch
+    while row > 1 and row * byt > (1 << 20): row //= 2
+    row = min(row, shape[0])
+
+    arg = {'chunks': (row,) + tuple(shape[1:])}
+    if compression: arg.update({'compression': compression, 'shuffle': True})
+
+    return arg
+
+# Creates a dataset with the chunked layout
+# dtb refers to an opened h5py file
+# key refers to the dataset name
+# shape refers to the shape of an empty dataset
+# data refers to the values to store instead
+def h5_dataset(dtb, key, shape=None, dtype='float64', data=None, batch=64, compression=None):
+
+    if data is not None: shape, dtype = data.shape, data.dtype
+    arg = h5_layout(shape, dtype=dtype, batch=batch, compression=compression)
+
+    return dtb.create_dataset(key, shape=shape, dtype=dtype, data=data, **arg)
+
+# Size of a chunk cache holding a few batches of rows of any dataset of a file
+# pth refers to the path of the file
+# batch refers to the amount of rows read at once
+# depth refers to the amount of batches to hold
+def h5_cache(pth, batch=64, depth=4):
+
+    siz = [1 << 20]
+
+    # Rows of a batch, rounded up to whole chunks
+    def visit(nme, obj):
+        if isinstance(obj, h5py.Dataset) and obj.chunks is not None and len(obj.shape) > 0:
+            row = -(-batch // obj.chunks[0]) * obj.chunks[0]
+            siz.append(row * int(np.prod(obj.shape[1:])) * obj.dtype.itemsize)
+
+    with h5py.File(pth, 'r') as dtb: dtb.visititems(visit)
+
+    return depth * max(siz)
+
+# Opens a HDF5 file with a chunk cache holding several batches of chunks
+# pth refers to the path of the file
+# mode refers to the opening mode
+# cache refers to the size of the chunk cache in bytes, sized from the chunks of the file by default
+# batch refers to the amount of rows read at once
+def h5_open(pth, mode='r', cache=None, batch=64):
+
+    if cache is None: cache = h5_cache(pth, batch=batch) if os.path.exists(pth) else 1 << 20
+
+    return h5py.File(pth, mode, rdcc_nbytes=cache, rdcc_nslots=10007, rdcc_w0=0.75)
+
 # Defines a function to rename the datasets for clearer management
 # storage refers to where to pick the dataset
 def rename(storage='./dataset'):
@@ -134,6 +263,49 @@ def kalman_filter(val, std_factor=3, smooth_window=5):
         
         return x_t
 
+# Kalman filter applied to all the rows of a matrix at once
+# The recursion goes along time but is vectorized across the epochs
+# mat refers to a 2D array of epochs, one per row
+# std_factor refers to the sought reduction of deviation of the signal
+# smooth_window refers to the convolution window for smoothing
+def kalman_filter_batch(mat, std_factor=3, smooth_window=5):
+
+    mat = np.asarray(mat, dtype='float64')
+    res = np.zeros(mat.shape)
+    std = np.std(mat, axis=1)
+    # Flat rows are left as zeros, as with kalman_filter
+    act = np.where(~(std < 1e-5))[0]
+    if len(act) == 0: return res
+
+    val, std = mat[act], std[act]
+    # Defines the variables
+    R = std**2
+    Q = (std / std_factor)**2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        tmp = np.nanmean(val[:,:5], axis=1)
+        x_t = np.where(np.isnan(tmp), np.nanmean(val, axis=1), tmp)
+    P_t = std.copy()
+
+    # Iterative construction
+    out = np.empty(val.shape)
+    out[:,0] = x_t
+    for k in range(1, val.shape[1]):
+        P_m = P_t + Q
+        fac = P_m / (P_m + R)
+        x_t = x_t + fac * (val[:,k] - x_t)
+        P_t = (1 - fac) * P_m
+        out[:,k] = x_t
+
+    # Apply smoothing
+    b = np.full(smooth_window, 1.0 / smooth_window)
+    res[act] = sg.lfilter(b, 1, out, axis=1)
+
+    # Memory efficiency
+    del val, out, P_t, R, Q
+
+    return res
+
 # Resize the 30s epochs for better understanding through convolution
 # size refers to the ending length
 # log refers whether to apply a logarithmic scale on the signal
@@ -172,9 +344,10 @@ def interpolate(val, size=1000):
 
 # Compute features related to the chaos theory
 # val refers to a 1D array
-def compute_tda_features(val):
+# diagrams refers to already computed upward and downward diagrams
+def compute_tda_features(val, diagrams=None):
     
-    res, fil = [], Levels(val)
+    res, fil = [], Levels(val, diagrams=diagrams)
 
     try: 
         u,d = fil.get_persistence()
@@ -311,12 +484,35 @@ def persistent_limits(vec):
 def compute_betti_curves(vec, mnu, mxu, mnd, mxd):
 
     fil = Levels(vec)
-    try: v,w =  lvl.betti_curves(mnu, mxu, mnd, mxd, num_points=100)
+    try: v,w =  fil.betti_curves(mnu, mxu, mnd, mxd, num_points=100)
     except: v,w = np.zeros(100), np.zeros(100)
     del fil
     
     return np.vstack((v,w))
 
+# Compute the Betti curves of already computed diagrams over common grids
+# dgs refers to a list of upward and downward diagrams
+def betti_curves_diagrams(dgs, mnu, mxu, mnd, mxd):
+
+    # Without complete limits, each curve gets its own grid
+    if not (mnu and mxu and mnd and mxd):
+        res = []
+        for ele in dgs:
+            try: res.append(np.vstack(Levels(diagrams=ele).betti_curves(mnu, mxu, mnd, mxd, num_points=100)))
+            except: res.append(np.zeros((2,100)))
+        return np.asarray(res)
+
+    v = betti_curves_batch([ele[0] for ele in dgs], np.linspace(mnu, mxu, num=100))
+    w = betti_curves_batch([ele[1] for ele in dgs], np.linspace(mnd, mxd, num=100))
+
+    return np.stack((v,w), axis=1)
+
+# Compute the Betti curves of all the rows at once
+# mat refers to a 2D array of epochs, one per row
+def compute_betti_curves_batch(mat, mnu, mxu, mnd, mxd):
+
+    return betti_curves_diagrams(sublevel_persistence_batch(mat), mnu, mxu, mnd, mxd)
+
 # Compute the landscapes
 # vec refers to a 1D array
 def compute_landscapes(vec, mnu, mxu, mnd, mxd):
@@ -328,6 +524,54 @@ def compute_landscapes(vec, mnu, mxu, mnd, mxd):
     
     return np.vstack((p,q))
 
+# Compute the landscapes of already computed diagrams over common grids
+# dgs refers to a list of upward and downward diagrams
+def landscapes_diagrams(dgs, mnu, mxu, mnd, mxd):
+
+    # Without complete limits, each landscape gets its own grid
+    if not (mnu and mxu and mnd and mxd):
+        res = []
+        for ele in dgs:
+            try: res.append(np.vstack(Levels(diagrams=ele).landscapes(mnu, mxu, mnd, mxd, num_points=100)))
+            except: res.append(np.zeros((20,100)))
+        return np.asarray(res)
+
+    p = landscapes_batch([ele[0] for ele in dgs], np.linspace(mnu, mxu, num=100))
+    q = landscapes_batch([ele[1] for ele in dgs], np.linspace(mnd, mxd, num=100))
+
+    return np.concatenate((p,q), axis=1)
+
+# Compute the landscapes of all the rows at once
+# mat refers to a 2D array of epochs, one per row
+def compute_landscapes_batch(mat, mnu, mxu, mnd, mxd):
+
+    return landscapes_diagrams(sublevel_persistence_batch(mat), mnu, mxu, mnd, mxd)
+
+# Applies a function of the diagrams to each element of a list
+# fun refers to a function taking a signal and its diagrams
+# dgs refers to a list of upward and downward diagrams
+def apply_diagrams(fun, dgs):
+
+    return np.asarray([fun(None, diagrams=ele) for ele in dgs])
+
+# Reads the diagrams of a range of epochs from their ragged storage
+# Each direction is stored as flat births and deaths, with the offsets of each epoch
+# pth refers to the HDF5 file of diagrams
+# key refers to the channel
+# beg, end refer to the rows to load
+def read_diagrams(pth, key, beg, end):
+
+    res = []
+
+    with h5py.File(pth, 'r') as dtb:
+        for drc in ['up', 'dw']:
+            off = dtb[key]['off_{}'.format(drc)][beg:end+1]
+            brt = dtb[key]['brt_{}'.format(drc)][off[0]:off[-1]]
+            dth = dtb[key]['dth_{}'.format(drc)][off[0]:off[-1]]
+            res.append(np.split(np.column_stack((brt, dth)), off[1:-1] - off[0]))
+
+    return list(zip(res[0], res[1]))
+
 # Easier to call and recreate the channel array
 # turn_on refers to the list of channels to turn-on
 def generate_channels(turn_on):
@@ -365,7 +609,13 @@ def generate_channels(turn_on):
 
 # Aims at filtering the NaN and replace them with mean values
 # arr refers to a 2D numpy array
-def remove_out_with_mean(arr):
+# mea refers to precomputed column means, used for block-wise processing
+def remove_out_with_mean(arr, mea=None):
+
+    if mea is not None:
+        ind = np.where(np.invert(np.isfinite(arr)))
+        arr[ind] = mea[ind[1]]
+        return arr
     
     col = np.unique(np.where(np.isnan(arr))[1])
     
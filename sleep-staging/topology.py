@@ -5,6 +5,182 @@
 try: from package.imports import *
 except: from imports import *
 
+# Stacks diagrams into pairs with the index of their diagram
+# Pairs without persistence are dropped, as they never contribute
+# dgs refers to a list of arrays of (birth, death) pairs
+
+def stack_diagrams(dgs):
+
+    dig = [np.asarray(ele, dtype='float64').reshape(-1, 2) for ele in dgs]
+    ids = np.concatenate([np.full(len(ele), idx, dtype=int) for idx, ele in enumerate(dig)] + [np.zeros(0, dtype=int)])
+    dig = np.vstack(dig + [np.zeros((0, 2))])
+    msk = dig[:,1] > dig[:,0]
+
+    return dig[msk], ids[msk]
+
+# Betti curves of many diagrams over a common grid
+# Each pair adds one on the grid points strictly between its birth and death
+# dgs refers to a list of arrays of (birth, death) pairs
+# val refers to the sorted discretization grid
+
+def betti_curves_batch(dgs, val):
+
+    dig, ids = stack_diagrams(dgs)
+    res = np.zeros((len(dgs), len(val)+1))
+
+    # First grid points above the birth and not below the death
+    np.add.at(res, (ids, np.searchsorted(val, dig[:,0], side='right')), 1)
+    np.add.at(res, (ids, np.searchsorted(val, dig[:,1], side='left')), -1)
+
+    return np.cumsum(res, axis=1)[:,:-1]
+
+# Betti curve of a single diagram
+# dig refers to an array of (birth, death) pairs
+# val refers to the sorted discretization grid
+
+def betti_curve(dig, val):
+
+    return betti_curves_batch([dig], val)[0]
+
+# Persistence landscapes of many diagrams over a common grid
+# Tent functions are evaluated for all pairs at once, the top ones kept per grid point
+# dgs refers to a list of arrays of (birth, death) pairs
+# val refers to the discretization grid
+# nb_landscapes refers to the amount of landscapes to build
+# batch_size refers to the amount of diagrams handled at once
+
+def landscapes_batch(dgs, val, nb_landscapes=10, batch_size=64):
+
+    val = np.asarray(val, dtype='float64')
+    res = np.zeros((len(dgs), nb_landscapes, len(val)))
+
+    for beg in range(0, len(dgs), batch_size):
+
+        # Pads the diagrams with empty pairs
+        dig = [np.asarray(ele, dtype='float64').reshape(-1, 2) for ele in dgs[beg:beg+batch_size]]
+        num = max([len(ele) for ele in dig] + [nb_landscapes])
+        pad = np.zeros((len(dig), num, 2))
+        for idx, ele in enumerate(dig): pad[idx,:len(ele)] = ele
+
+        # Tent functions, null outside of the pairs
+        b, d = pad[:,:,0,None], pad[:,:,1,None]
+        mid = (d + b) / 2.0
+        tnt = np.where(mid <= val, d - val, val - b)
+        tnt[(val < b) | (val > d)] = 0.0
+
+        # Largest values of each grid point, in decreasing order
+        tnt = np.partition(tnt, num - nb_landscapes, axis=1)[:,num-nb_landscapes:,:]
+        res[beg:beg+len(dig)] = -np.sort(-tnt, axis=1)
+
+        # Memory efficiency
+        del pad, tnt, b, d, mid
+
+    return res
+
+# Persistence landscapes of a single diagram
+# dig refers to an array of (birth, death) pairs
+# val refers to the discretization grid
+# nb_landscapes refers to the amount of landscapes to build
+
+def landscape(dig, val, nb_landscapes=10):
+
+    return landscapes_batch([dig], val, nb_landscapes=nb_landscapes)[0]
+
+# Roots of the given vertices in a batch of union-find forests, with path halving
+# par refers to the parents, one forest per row, updated in place
+# row refers to the row indexes
+# idx refers to one vertex per row
+
+def find_roots(par, row, idx):
+
+    while True:
+        pnt = par[row, idx]
+        act = pnt != idx
+        if not act.any(): return idx
+        grd = par[row, pnt]
+        par[row[act], idx[act]] = grd[act]
+        idx = np.where(act, grd, idx)
+
+# 0-dimensional sublevel persistence of all the rows of a matrix through union-find
+# Reproduces the finite pairs of the simplex trees built by Levels, row by row
+# The edges of all the rows are swept together, one rank at a time
+# mat refers to a 2D array of signals, one per row
+
+def sublevel_pairs(mat):
+
+    mat = np.asarray(mat, dtype='float64')
+    num, lth = mat.shape
+    if lth < 2: return [np.zeros((0, 2)) for _ in range(num)]
+
+    # Vertices get lowered by the edges inserted after them
+    brt = mat.copy()
+    brt[:,1:] = np.minimum(mat[:,1:], mat[:,:-1])
+    wgt = mat[:,:-1]
+    odr = np.argsort(wgt, axis=1, kind='mergesort')
+    par = np.tile(np.arange(lth), (num, 1))
+    row = np.arange(num)
+    p_b, p_d = np.empty((num, lth-1)), np.empty((num, lth-1))
+
+    # Each edge merges two components, the younger one dies
+    for rnk in range(lth-1):
+        k = odr[:,rnk]
+        i, j = find_roots(par, row, k), find_roots(par, row, k+1)
+        swp = brt[row, i] < brt[row, j]
+        yng, old = np.where(swp, j, i), np.where(swp, i, j)
+        p_b[:,rnk], p_d[:,rnk] = brt[row, yng], wgt[row, k]
+        par[row, yng] = old
+
+    # Sorted by decreasing persistence, pairs of null persistence last then dropped
+    kep = p_d > p_b
+    srt = np.argsort(np.where(kep, p_b - p_d, np.inf), axis=1, kind='mergesort')
+    p_b, p_d = np.take_along_axis(p_b, srt, axis=1), np.take_along_axis(p_d, srt, axis=1)
+    cnt = np.sum(kep, axis=1)
+
+    return [np.stack((p_b[idx,:cnt[idx]], p_d[idx,:cnt[idx]]), axis=1) for idx in range(num)]
+
+# 0-dimensional sublevel persistence of a 1-D signal through union-find
+# Plain loop over the edges, far cheaper than the batched sweep for a few rows
+# vec refers to a 1D array
+
+def sublevel_persistence(vec):
+
+    vec = np.asarray(vec, dtype='float64')
+    if len(vec) < 2: return np.zeros((0, 2))
+
+    # Vertices get lowered by the edges inserted after them
+    ver = vec.copy()
+    ver[1:] = np.minimum(vec[1:], vec[:-1])
+    par, brt, wgt = list(range(len(vec))), ver.tolist(), vec[:-1].tolist()
+    res = []
+
+    # Each edge merges two components, the younger one dies
+    for k in np.argsort(vec[:-1], kind='mergesort').tolist():
+        i, j = k, k+1
+        while par[i] != i: par[i] = par[par[i]]; i = par[i]
+        while par[j] != j: par[j] = par[par[j]]; j = par[j]
+        if brt[i] < brt[j]: i, j = j, i
+        if wgt[k] > brt[i]: res.append((brt[i], wgt[k]))
+        par[i] = j
+
+    # Sorted by decreasing persistence
+    res = np.asarray(res).reshape(-1, 2)
+
+    return res[np.argsort(res[:,0] - res[:,1], kind='mergesort')]
+
+# Upward and downward persistence of all the rows of a matrix
+# The batched sweep only pays off over large blocks, smaller ones go row by row
+# mat refers to a 2D array of signals, one per row
+# min_rows refers to the amount of rows from which the sweep is used
+
+def sublevel_persistence_batch(mat, min_rows=1024):
+
+    mat = np.asarray(mat, dtype='float64')
+
+    if len(mat) < min_rows: 
+        return [(sublevel_persistence(vec), sublevel_persistence(-vec)) for vec in mat]
+    else: 
+        return list(zip(sublevel_pairs(mat), sublevel_pairs(-mat)))
+
 # Computes associated persistent objects
 
 class Filtration: 
@@ -63,20 +239,7 @@ class Filtration:
     # graph refers whether to display a graph or not
     def betti_curves(self, dimension, m_n=None, m_x=None, num_points=100, graph=False):
 
-        # Aims at barcode discretization
-        def functionize(val, descriptor):
-
-            # Temporary function
-            def dirichlet(x):
-                return 1 if (x > descriptor[0]) and (x < descriptor[1]) else 0
-
-            # Vectorized function
-            fun = np.vectorize(dirichlet)
-
-            return fun(val)
-
         # Compute persistence
-        res = np.zeros(num_points)
         dig = self.alpha.persistence_intervals_in_dimension(dimension)
         dig = np.asarray([[ele[0], ele[1]] for ele in dig if ele[1] < np.inf])
 
@@ -86,7 +249,7 @@ class Filtration:
             m_n, m_x = np.min(dig), np.max(dig)
             val = np.linspace(m_n, m_x, num=num_points)
 
-        for ele in dig: res += functionize(val, ele)
+        res = betti_curve(dig, val)
 
         # Memory efficiency
         del dig, val
@@ -113,9 +276,6 @@ class Filtration:
         # m_n, m_x refer to the extrema for discretization
         def build_landscapes(dig, nb_landscapes, num_points, m_n, m_x):
 
-            # Prepares the discretization
-            lcd = np.zeros((nb_landscapes, num_points))
-
             # Observe whether absolute or relative
             if m_n and m_x:
                 stp = np.linspace(m_n, m_x, num=num_points)
@@ -123,19 +283,7 @@ class Filtration:
                 m_n, m_x = np.min(dig), np.max(dig)
                 stp = np.linspace(m_n, m_x, num=num_points)
 
-            # Use the triangular functions
-            for idx, ele in enumerate(stp):
-                val = []
-                for pair in dig:
-                    b, d = pair[0], pair[1]
-                    if (d+b)/2.0 <= ele <= d: val.append(d - ele)
-                    elif  b <= ele <= (d+b)/2.0: val.append(ele - b)
-                val.sort(reverse=True)
-                val = np.asarray(val)
-                for j in range(nb_landscapes):
-                    if (j < len(val)): lcd[j, idx] = val[j]
-
-            return lcd
+            return landscape(dig, stp, nb_landscapes=nb_landscapes)
         
         # Computes the persistent landscapes for both diagrams
         dig = self.alpha.persistence_intervals_in_dimension(dimension)
@@ -157,48 +305,68 @@ class Levels:
 
     # Initialization
     # vec refers to a 1D numpy array
-    def __init__(self, vec):
+    # backend refers to either 'union-find', swept with numpy, or 'gudhi' simplex trees
+    # diagrams refers to already computed upward and downward diagrams
+    def __init__(self, vec=None, backend='union-find', diagrams=None):
 
-        # Defines the filtration
-        self.simplex_up = gudhi.SimplexTree()
-        self.simplex_dw = gudhi.SimplexTree()
-        # Fullfill the simplexes
-        for i in np.arange(len(vec)): 
-            self.simplex_up.insert([i], filtration=vec[i])
-            self.simplex_dw.insert([i], filtration=-vec[i])
-        for i in np.arange(len(vec)-1): 
-            self.simplex_up.insert([i, i+1], filtration=vec[i])
-            self.simplex_dw.insert([i, i+1], filtration=-vec[i])
-        # Initialize the filtrations
-        self.simplex_up.initialize_filtration()
-        self.simplex_dw.initialize_filtration()
+        self.vec = vec
+        self.backend = backend
+        self.diagrams = diagrams
+
+        if backend == 'gudhi' and diagrams is None:
+            # Defines the filtration
+            self.simplex_up = gudhi.SimplexTree()
+            self.simplex_dw = gudhi.SimplexTree()
+            # Fullfill the simplexes
+            for i in np.arange(len(vec)): 
+                self.simplex_up.insert([i], filtration=vec[i])
+                self.simplex_dw.insert([i], filtration=-vec[i])
+            for i in np.arange(len(vec)-1): 
+                self.simplex_up.insert([i, i+1], filtration=vec[i])
+                self.simplex_dw.insert([i, i+1], filtration=-vec[i])
+            # Initialize the filtrations
+            self.simplex_up.initialize_filtration()
+            self.simplex_dw.initialize_filtration()
 
     # Get both persistences from the signal
     # graph refers whether to display a graph or not
     def get_persistence(self, graph=False):
 
         # Computes the persistences
-        dig_up = self.simplex_up.persistence()
-        dig_dw = self.simplex_dw.persistence()
+        if self.diagrams is not None:
+            dig_up, dig_dw = self.diagrams
+        elif self.backend == 'gudhi':
+            dig_up = self.simplex_up.persistence()
+            dig_dw = self.simplex_dw.persistence()
+        else:
+            dig_up = sublevel_persistence(self.vec)
+            dig_dw = sublevel_persistence(-np.asarray(self.vec, dtype='float64'))
+
+        # Filters infinite values
+        if self.backend == 'gudhi' and self.diagrams is None:
+            lst_up, lst_dw = dig_up, dig_dw
+            dig_up = np.asarray([[ele[1][0], ele[1][1]] for ele in dig_up if ele[1][1] < np.inf])
+            dig_dw = np.asarray([[ele[1][0], ele[1][1]] for ele in dig_dw if ele[1][1] < np.inf])
+        else:
+            lst_up = [(0, tuple(ele)) for ele in dig_up]
+            lst_dw = [(0, tuple(ele)) for ele in dig_dw]
+        # Diagrams are computed only once
+        self.diagrams = (dig_up, dig_dw)
 
         if graph:
             plt.figure(figsize=(18,8))
             fig = gd.GridSpec(2,2)
             plt.subplot(fig[0,0])
-            gudhi.plot_persistence_diagram(dig_up)
+            gudhi.plot_persistence_diagram(lst_up)
             plt.subplot(fig[1,0])
-            gudhi.plot_persistence_barcode(dig_up)
+            gudhi.plot_persistence_barcode(lst_up)
             plt.subplot(fig[0,1])
-            gudhi.plot_persistence_diagram(dig_dw)
+            gudhi.plot_persistence_diagram(lst_dw)
             plt.subplot(fig[1,1])
-            gudhi.plot_persistence_barcode(dig_dw)
+            gudhi.plot_persistence_barcode(lst_dw)
             plt.tight_layout()
             plt.show()
 
-        # Filters infinite values
-        dig_up = np.asarray([[ele[1][0], ele[1][1]] for ele in dig_up if ele[1][1] < np.inf])
-        dig_dw = np.asarray([[ele[1][0], ele[1][1]] for ele in dig_dw if ele[1][1] < np.inf])
-
         return dig_up, dig_dw
 
     # Defines the Betti curves out of the barcode diagrams
@@ -208,20 +376,7 @@ class Levels:
     # graph refers whether to display a graph or not
     def betti_curves(self, mnu=None, mxu=None, mnd=None, mxd=None, num_points=100, graph=False):
 
-        # Aims at barcode discretization
-        def functionize(val, descriptor):
-
-            # Temporary function
-            def dirichlet(x):
-                return 1 if (x > descriptor[0]) and (x < descriptor[1]) else 0
-
-            # Vectorized function
-            fun = np.vectorize(dirichlet)
-
-            return fun(val)
-
         # Compute persistence
-        v,w = np.zeros(num_points), np.zeros(num_points)
         u,d = self.get_persistence(graph=graph)
 
         if mnu and mxu and mnd and mxd:
@@ -233,8 +388,8 @@ class Levels:
             val_up = np.linspace(mnu, mxu, num=num_points)
             val_dw = np.linspace(mnd, mxd, num=num_points)
 
-        for ele in u: v += functionize(val_up, ele)
-        for ele in d: w += functionize(val_dw, ele)
+        v = betti_curve(u, val_up)
+        w = betti_curve(d, val_dw)
 
         # Memory efficiency
         del val_up, val_dw, u, d
@@ -263,9 +418,6 @@ class Levels:
         # m_n, m_x refer to the extrema for discretization
         def build_landscapes(dig, nb_landscapes, num_points, m_n, m_x):
 
-            # Prepares the discretization
-            lcd = np.zeros((nb_landscapes, num_points))
-
             # Observe whether absolute or relative
             if m_n and m_x:
                 stp = np.linspace(m_n, m_x, num=num_points)
@@ -273,19 +425,7 @@ class Levels:
                 m_n, m_x = np.min(dig), np.max(dig)
                 stp = np.linspace(m_n, m_x, num=num_points)
 
-            # Use the triangular functions
-            for idx, ele in enumerate(stp):
-                val = []
-                for pair in dig:
-                    b, d = pair[0], pair[1]
-                    if (d+b)/2.0 <= ele <= d: val.append(d - ele)
-                    elif  b <= ele <= (d+b)/2.0: val.append(ele - b)
-                val.sort(reverse=True)
-                val = np.asarray(val)
-                for j in range(nb_landscapes):
-                    if (j < len(val)): lcd[j, idx] = val[j]
-
-            return lcd
+            return landscape(dig, stp, nb_landscapes=nb_landscapes)
         
         # Computes the persistent landscapes for both diagrams
         u,d = self.get_persistence(graph=graph)